@@ -1,17 +1,6 @@
-import datetime
-import json
 import os
-import glob
-import numpy as np
-import datetime
-import math
-import torch
-from pytz import timezone
-from detectron2.structures import BoxMode
-from tqdm.notebook import tqdm
-from PIL import Image
-from skimage import measure
-from shapely.geometry import Polygon, MultiPolygon
+# detectron2, skimage and shapely are imported by the methods using them,
+# so that e.g. COCO conversion doesn't need detectron2 or torch
 from ._coco_format import _coco_converter
 from ._detectron_parser import _detectron_parser
 
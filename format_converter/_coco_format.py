@@ -7,8 +7,6 @@ import numpy as np
 import datetime
 from pytz import timezone
 import json
-from skimage import measure
-from shapely.geometry import Polygon, MultiPolygon
 
 class _coco_converter():
 
@@ -183,6 +181,9 @@ class _coco_converter():
             category_id: int, the id of the category of this piece of submask
             annotation_id: int, the id of this submask
         """
+        from skimage import measure
+        from shapely.geometry import Polygon, MultiPolygon
+
         # Find contours (boundary lines) around each sub-mask
         # Note: there could be multiple contours if the object
         # is partially occluded. (E.g. an elephant behind a tree)
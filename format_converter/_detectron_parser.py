@@ -3,12 +3,7 @@ import json
 import os
 import glob
 import numpy as np
-from skimage import measure
-from shapely.geometry import Polygon, MultiPolygon
 import math
-from detectron2.structures import BoxMode
-from tqdm.notebook import tqdm
-import torch
 
 class _detectron_parser():
 
@@ -38,6 +33,8 @@ class _detectron_parser():
         """
         the final operator parse the images in a path
         """
+        from tqdm.notebook import tqdm
+
         # These ids will be automatically increased as we go
         image_id = 0
         mask_path = glob.glob(os.path.join(path, "*mask.png"))
@@ -70,6 +67,8 @@ class _detectron_parser():
         """
         the final operator parse the images in a path
         """
+        from tqdm.notebook import tqdm
+
         # These ids will be automatically increased as we go
         image_id = 0
         mask_path = glob.glob(os.path.join(path, "*mask*.png"))
@@ -99,6 +98,10 @@ class _detectron_parser():
         return formal_output
 
     def _create_sub_mask_annotation(self, sub_mask, image_id, category_id):
+        from skimage import measure
+        from shapely.geometry import Polygon, MultiPolygon
+        from detectron2.structures import BoxMode
+
         # Find contours (boundary lines) around each sub-mask
         # Note: there could be multiple contours if the object
         # is partially occluded. (E.g. an elephant behind a tree)
@@ -265,16 +268,20 @@ class _detectron_parser():
             #BoxMode.XYXY_ABS will be dumped to 0
             json.dump(formal_output_dict, f)
 
-    def load_formal_output(self, path, bbox_mode=BoxMode.XYXY_ABS):
+    def load_formal_output(self, path, bbox_mode=None):
         '''
         Load the list produced by parse_detectron_ROI from a json file
         Args: 
             path: the path of the saved json file
 
-            bbox_mode: an object from BoxMode class
+            bbox_mode: an object from BoxMode class, BoxMode.XYXY_ABS if None
         Returns:
             the list of formal_output
         '''
+        if bbox_mode is None:
+            from detectron2.structures import BoxMode
+            bbox_mode = BoxMode.XYXY_ABS
+
         with open(path, 'r') as f:
             data = json.load(f)
         data = data['list']
@@ -1,14 +1,58 @@
 from pathlib import Path
 from tempfile import NamedTemporaryFile
 
-from .modeling.postprocessing import load_label_info_from_config, predict_on_batch_ROIs, predict_on_WSI
-from .utils.annotations import merge_annotations, create_asap_annotation_file
-
+# modules depending on torch, opencv, shapely, etc. are imported at first use,
+# so that importing the api, e.g., by CLI tools or spawned workers, is fast
 
 default_label_info_path = Path(__file__).parent / "label_info.ini"
 
+# if started, newer checkpoints dropped into the model directories are swapped in without restarting
+_default_checkpoint_watcher = None
+
+
+def start_watching_checkpoints(interval=60., settle_time=5.):
+    """
+    Keep the default label info live: poll the model directory of every class in the background,
+    and swap in newer models once they're loaded and warmed up
+
+    Parameters
+    ----------
+    interval: float
+        seconds between two polls of the model directories
+    settle_time: float
+        seconds a new model file must stay unmodified before it's loaded
+    """
+    from .modeling.registry import default_model_registry
+    from .modeling.watcher import CheckpointWatcher
+
+    global _default_checkpoint_watcher
+    if _default_checkpoint_watcher is None:
+        _default_checkpoint_watcher = CheckpointWatcher(default_label_info_path,
+                                                        interval=interval,
+                                                        settle_time=settle_time,
+                                                        model_registry=default_model_registry)
+    return _default_checkpoint_watcher.start()
+
+
+def stop_watching_checkpoints():
+    global _default_checkpoint_watcher
+    if _default_checkpoint_watcher is not None:
+        _default_checkpoint_watcher.stop()
+        _default_checkpoint_watcher = None
+
+
+def _get_default_label_info():
+    from .modeling.postprocessing import load_label_info_from_config
+    from .modeling.registry import default_model_registry
+
+    if _default_checkpoint_watcher is not None:
+        return _default_checkpoint_watcher.label_info
+    return load_label_info_from_config(default_label_info_path, model_registry=default_model_registry)
+
 
 def _aggregate_and_format_annotations(annotations):
+    from .utils.annotations import merge_annotations, create_asap_annotation_file
+
     merged_annotation = merge_annotations(annotations)
     tmp_file = NamedTemporaryFile()
     create_asap_annotation_file(merged_annotation, tmp_file.name)
@@ -24,7 +68,14 @@ def segment_ROI(ROIs,
                 upper_left_coords,
                 label_info=None,
                 batch_size=64,
-                return_masks=False):
+                return_masks=False,
+                fully_convolutional=False,
+                memory_budget=1024 ** 3,
+                cross_ROI_batching=False,
+                inference_config=None,
+                polygonize_workers=1,
+                morphology_workers=1,
+                callback=None):
     """
     Produce segmentation results on unseen ROIs and return annotations encoded in ASAP format
     Parameters
@@ -34,11 +85,29 @@ def segment_ROI(ROIs,
     upper_left_coords: List[Tuple]
         list of upper left coordinates for every ROI, i.e., (minx, miny) on level 0.
     label_info: pd.DataFrame
-        class labels and other attributes, use default_label_info as default
+        class labels and other attributes, use default_label_info as default,
+        whose models are cached across calls by default_model_registry,
+        and kept up to date after start_watching_checkpoints is called
     batch_size: int
         batch size for constructing in memory dataloader
     return_masks: bool
         if True, will also return a list of masks for ROIs. See below for details.
+    fully_convolutional: bool
+        if True, run models on large overlapping tiles instead of sliding patches;
+        only supported by models of the "torch" and "slim" backends, others raise a ValueError
+    memory_budget: int
+        bytes of activations available to a tile in fully convolutional mode
+    cross_ROI_batching: bool
+        if True, pool patches of many small ROIs into full batches
+    inference_config: ml_core.modeling.postprocessing.InferenceConfig, optional
+        how models are run, e.g., inference mode, channels_last and bfloat16 autocast
+    polygonize_workers: int
+        number of threads turning every mask into polygons; the annotations don't depend on it
+    morphology_workers: int
+        number of threads applying morphology to tiles of every heatmap; the masks don't depend on it
+    callback: ml_core.utils.profiling.StageRecorder or callable or List[callable], optional
+        sinks receiving start and stop events of every stage, e.g.,
+        ml_core.utils.profiling.SummarySink or ml_core.utils.profiling.MemorySink
 
     Returns
     -------
@@ -51,10 +120,23 @@ def segment_ROI(ROIs,
         ordered in the same order as labels in label_info dataframe.
 
     """
+    from .modeling.postprocessing import predict_on_batch_ROIs
+    from .utils.profiling import get_stage_recorder
+
+    recorder = get_stage_recorder(callback)
     if label_info is None:
-        label_info = load_label_info_from_config(default_label_info_path)
-    predicted_masks, annotations = predict_on_batch_ROIs(ROIs, upper_left_coords, label_info, batch_size)
-    xml_annotation = _aggregate_and_format_annotations(annotations)
+        label_info = _get_default_label_info()
+    predicted_masks, annotations = predict_on_batch_ROIs(ROIs, upper_left_coords, label_info, batch_size,
+                                                         fully_convolutional=fully_convolutional,
+                                                         memory_budget=memory_budget,
+                                                         cross_ROI_batching=cross_ROI_batching,
+                                                         inference_config=inference_config,
+                                                         polygonize_workers=polygonize_workers,
+                                                         morphology_workers=morphology_workers,
+                                                         callback=recorder)
+
+    with recorder.stage("xml_serialize", annotations=sum(map(len, annotations))):
+        xml_annotation = _aggregate_and_format_annotations(annotations)
 
     return xml_annotation if not return_masks else (xml_annotation, predicted_masks)
 
@@ -62,7 +144,15 @@ def segment_ROI(ROIs,
 def segment_WSI(slide_path,
                 label_info=None,
                 batch_size=64,
-                return_masks=False):
+                return_masks=False,
+                streaming=False,
+                tile_size=2048,
+                pipeline_config=None,
+                inference_config=None,
+                polygonize_workers=1,
+                morphology_workers=1,
+                model_resolution_masks=False,
+                callback=None):
     """
     Produce segmentation results on one unseen slide and return annotations encoded in ASAP format
 
@@ -71,11 +161,38 @@ def segment_WSI(slide_path,
     slide_path: str
         path to the unseen tif or svs format slide
     label_info: pd.DataFrame
-        class labels and other attributes, use default_label_info as default
+        class labels and other attributes, use default_label_info as default,
+        whose models are cached across calls by default_model_registry,
+        and kept up to date after start_watching_checkpoints is called
     batch_size: int
         batch size for constructing in memory dataloader
     return_masks: bool
         if True, will also return a list of masks for ROIs. See below for details.
+    streaming: bool
+        if True, read patches tile by tile from the slide instead of loading
+        the full level 1 image in memory
+    tile_size: int
+        side length of tiles read from the slide in streaming mode;
+        larger tiles mean fewer reads but higher peak memory
+    pipeline_config: ml_core.modeling.pipeline.PipelineConfig, optional
+        if provided, read tiles, run models and postprocess outputs concurrently
+        with the given worker counts and queue depths; always streams from the slide
+    inference_config: ml_core.modeling.postprocessing.InferenceConfig, optional
+        how models are run, e.g., inference mode, channels_last and bfloat16 autocast
+    polygonize_workers: int
+        number of threads turning every mask into polygons; the annotations don't depend on it;
+        not used by the pipeline, whose postprocess workers already polygonize masks concurrently
+    morphology_workers: int
+        number of threads applying morphology to tiles of every heatmap; the masks don't depend on it;
+        not used by the pipeline either
+    model_resolution_masks: bool
+        if True, keep heatmaps at the resolution models ran at, and only scale polygons to level 0,
+        which saves memory and time on large biopsies; returned masks are then at model resolution;
+        not used by the pipeline either
+    callback: ml_core.utils.profiling.StageRecorder or callable or List[callable], optional
+        sinks receiving start and stop events of every stage, e.g., a progress callback,
+        ml_core.utils.profiling.SummarySink, ml_core.utils.profiling.JSONReportSink
+        or ml_core.utils.profiling.MemorySink
 
     Returns
     -------
@@ -86,11 +203,30 @@ def segment_WSI(slide_path,
         every item is a list containing masks for every label class,
         ordered in the same order as labels in label_info dataframe.
     """
+    from .modeling.postprocessing import predict_on_WSI
+    from .modeling.pipeline import predict_on_WSI_pipelined
+    from .utils.profiling import get_stage_recorder
 
+    recorder = get_stage_recorder(callback)
     if label_info is None:
-        label_info = load_label_info_from_config(default_label_info_path)
-
-    predicted_masks, annotations = predict_on_WSI(slide_path, label_info, batch_size)
-    xml_annotation = _aggregate_and_format_annotations(annotations)
+        label_info = _get_default_label_info()
+
+    if pipeline_config is not None:
+        predicted_masks, annotations = predict_on_WSI_pipelined(slide_path, label_info, batch_size,
+                                                                config=pipeline_config,
+                                                                inference_config=inference_config,
+                                                                callback=recorder)
+    else:
+        predicted_masks, annotations = predict_on_WSI(slide_path, label_info, batch_size,
+                                                      streaming=streaming,
+                                                      tile_size=tile_size,
+                                                      inference_config=inference_config,
+                                                      polygonize_workers=polygonize_workers,
+                                                      morphology_workers=morphology_workers,
+                                                      model_resolution_masks=model_resolution_masks,
+                                                      callback=recorder)
+
+    with recorder.stage("xml_serialize", annotations=sum(map(len, annotations))):
+        xml_annotation = _aggregate_and_format_annotations(annotations)
 
     return xml_annotation if not return_masks else (xml_annotation, predicted_masks)
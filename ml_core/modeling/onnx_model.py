@@ -0,0 +1,103 @@
+import inspect
+from pathlib import Path
+
+import numpy as np
+import torch
+
+"""
+========= ONNX Export and ONNX Runtime Inference ==========
+
+Exported graphs only contain the forward pass, so deployments running them don't need
+pytorch lightning, optimizers or checkpoints; onnxruntime is only imported when a graph is loaded.
+"""
+
+
+def export_model_to_onnx(model, onnx_path, patch_size, in_channels=3, opset_version=11):
+    """
+    Export the forward pass of a model to an ONNX graph with a dynamic batch axis
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        model to export, e.g., UNet loaded from a checkpoint
+    onnx_path : str or Path
+        path of the exported graph
+    patch_size : int
+        side length of input patches; fixed in the graph
+    in_channels : int
+        number of input channels
+    opset_version : int
+        ONNX opset used for the export
+
+    Returns
+    -------
+    onnx_path : Path
+        path of the exported graph
+    """
+    onnx_path = Path(onnx_path)
+    onnx_path.parent.mkdir(parents=True, exist_ok=True)
+
+    model = model.cpu().eval()
+    dummy_input = torch.zeros((1, in_channels, patch_size, patch_size), dtype=torch.float32)
+
+    # recent versions of pytorch export with dynamo by default, which needs onnxscript
+    kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(model,
+                          dummy_input,
+                          str(onnx_path),
+                          input_names=["input"],
+                          output_names=["output"],
+                          dynamic_axes={"input": {0: "batch"}, "output": {0: "batch"}},
+                          opset_version=opset_version,
+                          **kwargs)
+    return onnx_path
+
+
+class ONNXModel:
+    """
+    Run an exported graph with ONNX Runtime behind the same interface as models used in inference,
+    i.e., it has a device, can be frozen, and maps a batch tensor to a logits tensor
+    """
+
+    def __init__(self, onnx_path, providers=("CPUExecutionProvider",), intra_op_num_threads=0):
+        """
+        Parameters
+        ----------
+        onnx_path : str or Path
+            path to an exported graph
+        providers : Tuple[str]
+            execution providers of ONNX Runtime, in order of preference
+        intra_op_num_threads : int
+            number of threads used within operators; let ONNX Runtime decide if 0
+        """
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intra_op_num_threads
+
+        self.onnx_path = Path(onnx_path)
+        self.session = onnxruntime.InferenceSession(str(onnx_path), options, providers=list(providers))
+        self.input_name = self.session.get_inputs()[0].name
+        self.device = torch.device("cpu")
+
+    def freeze(self):
+        # graphs are always in inference mode
+        pass
+
+    def eval(self):
+        return self
+
+    def to(self, *args, **kwargs):
+        # inputs are always copied to numpy arrays on CPU, so devices and memory formats don't apply
+        return self
+
+    def __call__(self, img):
+        img = np.ascontiguousarray(img.detach().cpu().numpy(), dtype=np.float32)
+        output, = self.session.run(None, {self.input_name: img})
+        return torch.from_numpy(output)
+
+
+def load_model_from_onnx(onnx_path):
+    return ONNXModel(onnx_path) if Path(onnx_path).exists() else None
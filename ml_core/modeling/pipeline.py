@@ -0,0 +1,259 @@
+import threading
+from queue import Queue, Empty, Full
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+from .postprocessing import get_biopsy_bbox, get_biopsy_patches_coords, group_label_info_by_extractor, \
+    patches_to_tensor, postprocess_biopsy_output, predict_with_models, read_slide_and_detect_biopsies, \
+    InferenceConfig
+from ..utils.profiling import get_stage_recorder
+from ..utils.slide_utils import get_best_level_for_resize, group_patches_coords_by_tile, \
+    split_patches_coords_by_tile, read_patches_of_tile
+
+"""
+========= Pipelined Inference on Whole Slide Images ==========
+
+Stages run concurrently and are connected by bounded queues:
+    1) a thread pool reading tiles from the slide and cropping patches;
+    2) the model stage, batching patches and running every model of a class group;
+    3) a thread pool stitching heatmaps, applying morphology and polygonizing masks.
+"""
+
+
+class PipelineConfig:
+    """
+    Worker counts and queue depths of the pipelined WSI inference
+    """
+
+    def __init__(self,
+                 read_workers: int = 4,
+                 postprocess_workers: int = 2,
+                 prefetch_depth: int = 16,
+                 postprocess_queue_depth: int = 4,
+                 tile_size: int = 2048):
+        """
+        Parameters
+        ----------
+        read_workers : int
+            number of threads reading tiles from the slide and preparing patches
+        postprocess_workers : int
+            number of threads turning model outputs into masks and annotations
+        prefetch_depth : int
+            maximum number of tiles read ahead of the model stage;
+            together with tile_size, it bounds the memory of prefetched patches
+        postprocess_queue_depth : int
+            maximum number of (biopsy, class group) outputs waiting for postprocessing;
+            the model stage blocks when it's reached
+        tile_size : int
+            side length of the tiles read from the slide, in the resized frame
+        """
+        assert read_workers > 0 and postprocess_workers > 0, "Every stage needs at least one worker."
+        assert prefetch_depth > 0 and postprocess_queue_depth > 0, "Queue depths must be positive."
+
+        self.read_workers = read_workers
+        self.postprocess_workers = postprocess_workers
+        self.prefetch_depth = prefetch_depth
+        self.postprocess_queue_depth = postprocess_queue_depth
+        self.tile_size = tile_size
+
+
+class _Job:
+    # patches of one biopsy for one group of classes sharing the same extractor
+    def __init__(self, biopsy_id, group_id, coords, tiles_coords, upper_left, resize, level):
+        self.biopsy_id = biopsy_id
+        self.group_id = group_id
+        self.coords = coords
+        self.tiles_coords = tiles_coords
+        self.upper_left = upper_left
+        self.resize = resize
+        self.level = level
+
+
+def _put_until_stopped(queue, item, stop_event, timeout=0.1):
+    while not stop_event.is_set():
+        try:
+            queue.put(item, timeout=timeout)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def _read_tile(slide, job, tile_coords, patch_size, recorder):
+    with recorder.stage("slide_read", patches=len(tile_coords)):
+        patches = read_patches_of_tile(slide, tile_coords, patch_size, job.upper_left, job.resize, job.level)
+    with recorder.stage("tensorize", patches=len(patches)):
+        return patches_to_tensor(patches)
+
+
+def _postprocess_job(job, outputs, biopsy_contour, extractor, rows, label_info, level_base, recorder):
+    results = []
+    for (layer_index, row), output in zip(rows, outputs):
+        mask, annotation = postprocess_biopsy_output(output, job.coords, biopsy_contour,
+                                                     extractor, row, label_info, level_base,
+                                                     recorder=recorder)
+        results.append((layer_index, mask, annotation))
+    return job.biopsy_id, results
+
+
+def predict_on_WSI_pipelined(slide_path,
+                             label_info,
+                             batch_size=64,
+                             level_base=4,
+                             config: PipelineConfig = None,
+                             inference_config: InferenceConfig = None,
+                             callback=None):
+    """
+    Same as "predict_on_WSI" in streaming mode, but reading, inference and postprocessing
+    run concurrently, so that the model stage is not starved by slide decoding
+
+    Parameters
+    ----------
+    slide_path : str or Path
+        path to the slide
+    label_info : pd.DataFrame
+        class labels, models and other attributes
+    batch_size : int
+        batch size used for inference
+    level_base : int
+        downsampling factor between every two adjacent levels
+    config : PipelineConfig or None
+        worker counts and queue depths; use the default config if None
+    inference_config : InferenceConfig or None
+        how models are run, e.g., precision and memory format; use the default config if None
+    callback : StageRecorder or callable or List[callable] or None
+        sinks receiving start and stop events of every stage, same as in "predict_on_WSI";
+        stages of different workers overlap in time
+
+    Returns
+    -------
+    predicted_masks : List[List[np.array]]
+        masks for every biopsy, one for each class in label_info
+    annotations : List[List[ASAPAnnotation]]
+        annotations for every biopsy
+    """
+    config = PipelineConfig() if config is None else config
+    # shared by all batches, so that autocast is only checked once per model
+    inference_config = InferenceConfig() if inference_config is None else inference_config
+    recorder = get_stage_recorder(callback)
+
+    slide, _, biopsy_contours = read_slide_and_detect_biopsies(slide_path, level_base, streaming=True,
+                                                               tile_size=config.tile_size, recorder=recorder)
+
+    # change level from 0 to 1
+    extractor_groups = group_label_info_by_extractor(label_info, level_base)
+    for _, rows in extractor_groups:
+        for _, row in rows:
+            row.model.freeze()
+
+    jobs = []
+    for biopsy_id, biopsy_contour in enumerate(biopsy_contours):
+        bbox = get_biopsy_bbox(biopsy_contour)
+        for group_id, (extractor, _) in enumerate(extractor_groups):
+            resize = extractor.resize / level_base
+            coords = group_patches_coords_by_tile(get_biopsy_patches_coords(biopsy_contour, extractor),
+                                                  config.tile_size)
+            jobs.append(_Job(biopsy_id, group_id, coords,
+                             split_patches_coords_by_tile(coords, config.tile_size),
+                             upper_left=(bbox[0] * level_base, bbox[1] * level_base),
+                             resize=resize,
+                             level=get_best_level_for_resize(slide, resize)))
+
+    predicted_masks = [[None for _ in range(len(label_info))] for _ in biopsy_contours]
+    annotations = [[[] for _ in range(len(label_info))] for _ in biopsy_contours]
+
+    tile_queue = Queue(maxsize=config.prefetch_depth)
+    stop_event = threading.Event()
+    postprocess_slots = threading.BoundedSemaphore(config.postprocess_queue_depth)
+
+    with ThreadPoolExecutor(config.read_workers) as read_pool, \
+            ThreadPoolExecutor(config.postprocess_workers) as postprocess_pool:
+
+        def produce_tiles():
+            # submit reads in order; the bounded queue keeps reads from running too far ahead,
+            # and a None future marks the end of every job
+            for job_id, job in enumerate(jobs):
+                patch_size = extractor_groups[job.group_id][0].patch_size
+                for tile_coords in job.tiles_coords:
+                    future = read_pool.submit(_read_tile, slide, job, tile_coords, patch_size, recorder)
+                    if not _put_until_stopped(tile_queue, (job_id, future), stop_event):
+                        future.cancel()
+                        return
+                if not _put_until_stopped(tile_queue, (job_id, None), stop_event):
+                    return
+
+        producer = threading.Thread(target=produce_tiles, daemon=True)
+        producer.start()
+
+        postprocess_futures = []
+        buffer, buffered_count = [], 0
+        job_outputs = None
+
+        def run_models(job, batch):
+            models = [row.model for _, row in extractor_groups[job.group_id][1]]
+            outputs = predict_with_models(models, [(batch,)], inference_config=inference_config, recorder=recorder)
+            for job_output, output in zip(job_outputs, outputs):
+                job_output.append(output)
+
+        try:
+            for _ in tqdm(range(len(jobs))):
+                while True:
+                    job_id, future = tile_queue.get()
+                    job = jobs[job_id]
+                    extractor, rows = extractor_groups[job.group_id]
+
+                    if job_outputs is None:
+                        job_outputs = [[] for _ in rows]
+
+                    if future is not None:
+                        patches = future.result()
+                        buffer.append(patches)
+                        buffered_count += len(patches)
+
+                        while buffered_count >= batch_size:
+                            patches = buffer[0] if len(buffer) == 1 else torch.cat(buffer)
+                            buffer, buffered_count = [patches[batch_size:]], len(patches) - batch_size
+                            run_models(job, patches[:batch_size])
+                        continue
+
+                    # end of the job: flush the remaining patches and hand over to postprocessing
+                    if buffered_count > 0:
+                        run_models(job, torch.cat(buffer))
+                    buffer, buffered_count = [], 0
+
+                    outputs = [np.concatenate(job_output) if job_output else np.zeros((0,), dtype=np.float32)
+                               for job_output in job_outputs]
+                    job_outputs = None
+
+                    postprocess_slots.acquire()
+                    postprocess_future = postprocess_pool.submit(_postprocess_job, job, outputs,
+                                                                 biopsy_contours[job.biopsy_id],
+                                                                 extractor, rows, label_info, level_base, recorder)
+                    postprocess_future.add_done_callback(lambda _: postprocess_slots.release())
+                    postprocess_futures.append(postprocess_future)
+                    break
+
+            for postprocess_future in postprocess_futures:
+                biopsy_id, results = postprocess_future.result()
+                for layer_index, mask, annotation in results:
+                    predicted_masks[biopsy_id][layer_index] = mask
+                    annotations[biopsy_id][layer_index] = annotation
+
+        finally:
+            # unblock and stop the producer in case of failures
+            stop_event.set()
+            while True:
+                try:
+                    _, future = tile_queue.get_nowait()
+                    if future is not None:
+                        future.cancel()
+                except Empty:
+                    break
+            producer.join()
+
+    annotations = [list(chain.from_iterable(biopsy_annotations)) for biopsy_annotations in annotations]
+    return predicted_masks, annotations
@@ -1,4 +1,8 @@
 import configparser
+import contextlib
+import copy
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 from datetime import datetime
 
@@ -18,18 +22,28 @@ from shapely.affinity import affine_transform
 
 from ..preprocessing.patches_extraction import extract_img_patches, Extractor
 from ..utils.annotations import mask_to_annotation
+from ..utils.profiling import get_stage_recorder, record_stage_iteration
+from ..utils.tracing import traced
 from .unet import UNet
-from ..utils.slide_utils import read_full_slide_by_level, generate_patches_coords, get_biopsy_contours, \
-    get_biopsy_covered_patches_coords
+from .onnx_model import load_model_from_onnx
+from .quantization import load_quantized_model
+from .slim_checkpoint import load_model_from_slim_checkpoint
+from ..utils.slide_utils import generate_patches_coords, get_biopsy_contours, \
+    get_biopsy_covered_patches_coords, read_slide, read_patches_from_slide, group_patches_coords_by_tile, \
+    read_level_thumbnail, read_region_from_slide
 
 """
 ========= Morphological Postprocessing on Masks ====================
 """
 
+OPENING_KERNEL_SIZE = 7
+OPENING_ITERATIONS = 3
 
+
+@traced
 def enhance_heatmap(heatmap):
     # Remove Hole or noise through the use of opening, closing in Morphology module
-    kernel = np.ones((7, 7), np.uint8)
+    kernel = np.ones((OPENING_KERNEL_SIZE, OPENING_KERNEL_SIZE), np.uint8)
 
     # remove noise (small bright regions) in background
     binary_heatmap = np.where(np.array(heatmap) >= 127, 255, 0)
@@ -37,7 +51,62 @@ def enhance_heatmap(heatmap):
     enhanced_heatmap = cv2.morphologyEx(binary_heatmap,
                                         cv2.MORPH_OPEN,
                                         kernel,
-                                        iterations=3)
+                                        iterations=OPENING_ITERATIONS)
+
+    return enhanced_heatmap
+
+
+@traced
+def enhance_heatmap_by_tiles(heatmap, tile_size=1024, workers=1):
+    """
+    Keep the pixels of a heatmap inside the opening of its binary heatmap, the same as masking
+    the heatmap with enhance_heatmap, but tile by tile: every tile is thresholded, opened and masked
+    at once with a halo wide enough for the opening to be exact, and tiles without any pixel
+    above the binary threshold are skipped, since opening never adds pixels
+
+    Parameters
+    ----------
+    heatmap : 2D np.array
+        uint8 heatmap
+    tile_size : int
+        side length of the tiles, without the halo
+    workers : int
+        number of threads processing tiles concurrently
+
+    Returns
+    -------
+    enhanced_heatmap : 2D np.array
+        uint8 heatmap, 0 outside the opening
+    """
+    heatmap = np.asarray(heatmap, dtype=np.uint8)
+    height, width = heatmap.shape
+    kernel = np.ones((OPENING_KERNEL_SIZE, OPENING_KERNEL_SIZE), np.uint8)
+    # every erosion and dilation of the opening reads pixels up to the kernel radius away
+    halo = 2 * OPENING_ITERATIONS * (OPENING_KERNEL_SIZE // 2)
+
+    # the input isn't modified, so that tiles read the original pixels of their neighbors' halos
+    enhanced_heatmap = np.zeros_like(heatmap)
+
+    def enhance_tile(origin):
+        x, y = origin
+        tile = heatmap[y:y + tile_size, x:x + tile_size]
+        if tile.max() < 127:
+            return
+
+        top, left = max(y - halo, 0), max(x - halo, 0)
+        _, binary_heatmap = cv2.threshold(heatmap[top:y + tile_size + halo, left:x + tile_size + halo],
+                                          126, 255, cv2.THRESH_BINARY)
+        opening = cv2.morphologyEx(binary_heatmap, cv2.MORPH_OPEN, kernel, iterations=OPENING_ITERATIONS)
+        np.bitwise_and(tile, opening[y - top:y - top + tile.shape[0], x - left:x - left + tile.shape[1]],
+                       out=enhanced_heatmap[y:y + tile_size, x:x + tile_size])
+
+    origins = [(x, y) for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+    if workers > 1:
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(enhance_tile, origins))
+    else:
+        for origin in origins:
+            enhance_tile(origin)
 
     return enhanced_heatmap
 
@@ -47,18 +116,207 @@ def enhance_heatmap(heatmap):
 """
 
 
+@traced
 def construct_inference_dataloader_from_patches(patches, batch_size):
-    patches_tensor = torch.stack(list(map(lambda img: torchvision.transforms.ToTensor()(img), patches)))
+    if isinstance(patches, np.ndarray):
+        patches_tensor = patches_to_tensor(patches)
+    else:
+        patches_tensor = torch.stack(list(map(lambda img: torchvision.transforms.ToTensor()(img), patches)))
     dataset = TensorDataset(patches_tensor)
     dataloader = DataLoader(dataset, batch_size=batch_size, pin_memory=True)
     return dataloader
 
 
-def construct_inference_dataloader_from_ROI(ROI, extractor, batch_size):
+@traced
+def patches_to_tensor(patches):
+    # equivalent to torchvision.transforms.ToTensor() on every uint8 patch, but for a stack of patches
+    patches_tensor = torch.from_numpy(np.ascontiguousarray(patches))
+    return patches_tensor.permute(0, 3, 1, 2).float().div(255).contiguous()
+
+
+def construct_inference_batches_from_slide(slide, coords, upper_left, resize, patch_size, batch_size,
+                                           tile_size=2048, recorder=None):
+    """
+    Stream batches of patches read tile by tile from a slide,
+    so that the region covered by the patches is never loaded as a whole
+
+    Parameters
+    ----------
+    slide : openslide.OpenSlide
+        slide to read patches from
+    coords : array-like with shape (n, 2)
+        (x, y) coordinates of patches in the resized frame, relative to upper_left;
+        batches are yielded in the same order
+    upper_left : tuple(float, float)
+        upper left corner of the region, defined in level-0 coordinate system
+    resize : float
+        resize factor from level 0 to the resized frame
+    patch_size : int
+        height and width of a patch
+    batch_size : int
+        number of patches in every batch
+    tile_size : int
+        side length of the tiles read from the slide, in the resized frame
+    recorder : StageRecorder or None
+        if not None, record reading tiles as "slide_read" and building tensors as "tensorize"
+
+    Yields
+    ------
+    batch : Tuple[torch.Tensor]
+        a tuple with a single tensor of patches, same as batches from a TensorDataset
+    """
+    recorder = get_stage_recorder(recorder)
+
+    def to_tensor(patches):
+        with recorder.stage("tensorize", patches=len(patches)):
+            return patches_to_tensor(patches)
+
+    buffer, buffered_count = [], 0
+    tiles = read_patches_from_slide(slide, coords, patch_size, upper_left, resize, tile_size=tile_size)
+    for patches in record_stage_iteration(recorder, "slide_read", tiles):
+        buffer.append(patches)
+        buffered_count += len(patches)
+
+        while buffered_count >= batch_size:
+            patches = np.concatenate(buffer)
+            buffer, buffered_count = [patches[batch_size:]], len(patches) - batch_size
+            yield to_tensor(patches[:batch_size]),
+
+    if buffered_count > 0:
+        yield to_tensor(np.concatenate(buffer)),
+
+
+@traced
+def extract_inference_patches_from_ROI(ROI, extractor, tissue_only=False):
+    """
+    Extract patches and their coordinates from a ROI for inference
+
+    Parameters
+    ----------
+    ROI : PIL.Image
+        region-of-interest
+    extractor : Extractor
+        extractor deciding the resizing and patch geometry
+    tissue_only : bool
+        if True, only patches with tissue in it are kept, see "extract_img_patches"
+
+    Returns
+    -------
+    patches : np.array with shape (n, patch_size, patch_size, 3)
+        extracted patches
+    output_coords : np.array with shape (n, 2)
+        (x, y) coordinates of every patch in the resized ROI
+    """
     patches, indices = extract_img_patches(img=ROI, extractor=extractor)
-    return construct_inference_dataloader_from_patches(patches, batch_size)
 
+    resized_width, resized_height = int(ROI.size[0] * extractor.resize), int(ROI.size[1] * extractor.resize)
+    output_coords = generate_patches_coords(resized_width,
+                                            resized_height,
+                                            extractor.patch_size,
+                                            extractor.stride_size,
+                                            extractor.mirror_pad_size)
+    if tissue_only:
+        patches, output_coords = patches[indices], output_coords[indices]
+
+    return patches, output_coords
+
+
+@traced
+def construct_inference_dataloader_from_ROI(ROI, extractor, batch_size, tissue_only=False, return_coords=False):
+    """
+    Extract patches from a ROI and wrap them in a dataloader
+
+    Parameters
+    ----------
+    ROI : PIL.Image
+        region-of-interest
+    extractor : Extractor
+        extractor deciding the resizing and patch geometry
+    batch_size : int
+        batch size of the dataloader
+    tissue_only : bool
+        if True, only patches with tissue in it are kept, see "extract_img_patches"
+    return_coords : bool
+        if True, also return coordinates of the kept patches in the resized ROI
+
+    Returns
+    -------
+    dataloader : DataLoader
+        dataloader of patch tensors
+    output_coords : np.array with shape (n, 2), optional
+        (x, y) coordinates of every patch in the dataloader
+    """
+    patches, output_coords = extract_inference_patches_from_ROI(ROI, extractor, tissue_only=tissue_only)
+    dataloader = construct_inference_dataloader_from_patches(patches, batch_size)
+    return dataloader if not return_coords else (dataloader, output_coords)
+
+
+@traced
+def construct_inference_dataloader_from_tiles(ROI, extractor, tile_size, halo, batch_size=1):
+    tiles, interior_coords = extractor.extract_tiles(ROI, tile_size, halo)
+    return construct_inference_dataloader_from_patches(tiles, batch_size), interior_coords
+
+
+@traced
+def estimate_tile_size(model, memory_budget, halo=0, max_image_side=None):
+    """
+    Estimate the largest square tile a fully convolutional model can run on
+    within a memory budget, by counting the activations of a small probe input
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        a fully convolutional model, e.g., UNet with padding;
+        models of the "onnx" and "int8" backends aren't supported and raise a ValueError
+    memory_budget : int
+        bytes available for activations of a single tile
+    halo : int
+        halo on each side of a tile; the tile always keeps a non-empty interior
+    max_image_side : int or None
+        if not None, tiles are never larger than what's needed to cover
+        an image with this side length in one tile
+
+    Returns
+    -------
+    tile_size : int
+        tile side length, a multiple of the total downsampling factor of the model
+    """
+    if not isinstance(model, torch.nn.Module):
+        # ONNX and int8 TorchScript models don't expose their modules and parameters to probe
+        raise ValueError(f"Fully convolutional mode only supports models of the 'torch' and 'slim' backends, "
+                         f"not {type(model).__name__}.")
+
+    multiple = 2 ** (getattr(model, "depth", 1) - 1)
+    probe_size = 4 * multiple
+    in_channels = next(m for m in model.modules() if isinstance(m, torch.nn.Conv2d)).in_channels
+    parameter = next(model.parameters())
+
+    activation_count = [0]
+
+    def count_activations(module, inputs, output):
+        activation_count[0] += output.numel()
+
+    leaf_modules = [m for m in model.modules() if not list(m.children())]
+    hooks = [m.register_forward_hook(count_activations) for m in leaf_modules]
+    try:
+        with torch.no_grad():
+            model(torch.zeros((1, in_channels, probe_size, probe_size),
+                              dtype=parameter.dtype, device=parameter.device))
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    bytes_per_pixel = activation_count[0] * parameter.element_size() / probe_size ** 2
+    tile_size = int(np.sqrt(memory_budget / bytes_per_pixel))
+
+    if max_image_side is not None:
+        tile_size = min(tile_size, max_image_side + 2 * halo + multiple - 1)
 
+    min_tile_size = 2 * halo + multiple
+    return max(tile_size // multiple * multiple, int(np.ceil(min_tile_size / multiple)) * multiple)
+
+
+@traced
 def load_model_from_checkpoint(ckpt_path, model_class: LightningModule = UNet):
     model = model_class.load_from_checkpoint(ckpt_path) if Path(ckpt_path).exists() else None
     if model is not None and torch.cuda.is_available():
@@ -66,7 +324,142 @@ def load_model_from_checkpoint(ckpt_path, model_class: LightningModule = UNet):
     return model
 
 
-def predict_with_model(model: LightningModule, dataloader):
+# inference backends: name -> (suffix of model files, loader)
+model_backends = {
+    "torch": (".ckpt", load_model_from_checkpoint),
+    "onnx": (".onnx", load_model_from_onnx),
+    "int8": (".int8.pt", load_quantized_model),
+    "slim": (".slim", load_model_from_slim_checkpoint),
+}
+
+
+def is_autocast_supported(device, dtype):
+    """
+    Whether autocast with dtype is available and fast on device
+    """
+    # torch.autocast needs torch >= 1.10, while older versions are still accepted by requirements.txt
+    if not hasattr(torch, "autocast"):
+        return False
+
+    if device.type == "cuda":
+        return dtype == torch.float16 or torch.cuda.is_bf16_supported()
+
+    if device.type == "cpu" and dtype == torch.bfloat16:
+        # bf16 on CPU without hardware support is emulated and much slower than fp32
+        try:
+            return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+        except (AttributeError, RuntimeError):
+            return False
+
+    return False
+
+
+class InferenceConfig:
+    """
+    How models are run at inference time
+    """
+
+    def __init__(self,
+                 inference_mode: bool = True,
+                 channels_last: bool = False,
+                 autocast_dtype: torch.dtype = None,
+                 tolerance: float = 1e-2):
+        """
+        Parameters
+        ----------
+        inference_mode : bool
+            if True, run models under torch.inference_mode, otherwise under torch.no_grad;
+            torch.no_grad is used anyway on torch < 1.9, which has no inference mode
+        channels_last : bool
+            if True, convert models and inputs to the channels_last memory format
+        autocast_dtype : torch.dtype or None
+            if not None, e.g., torch.bfloat16, run models under autocast with this dtype;
+            models stay in float32 on devices not supporting it, and on torch < 1.10
+        tolerance : float or None
+            only used with autocast; maximal absolute difference of probabilities between the autocast
+            and the float32 outputs on the first batch of every model, beyond which the model stays in float32;
+            no check if None
+        """
+        self.inference_mode = inference_mode
+        self.channels_last = channels_last
+        self.autocast_dtype = autocast_dtype
+        self.tolerance = tolerance
+
+        # whether autocast is used for every model, decided on its first batch
+        self._autocast_models = weakref.WeakKeyDictionary()
+        # channels_last copies of models, converted once per model
+        self._prepared_models = weakref.WeakKeyDictionary()
+
+    def grad_context(self):
+        if self.inference_mode and hasattr(torch, "inference_mode"):
+            return torch.inference_mode()
+        return torch.no_grad()
+
+    def autocast_context(self, device, enabled=True):
+        if not enabled or self.autocast_dtype is None or not hasattr(torch, "autocast"):
+            return contextlib.nullcontext()
+        return torch.autocast(device.type, dtype=self.autocast_dtype)
+
+    def prepare_model(self, model):
+        """
+        Return model converted for inference; models are shared by the model registry,
+        so a converted copy is returned instead of converting model in place
+        """
+        if not self.channels_last or not isinstance(model, torch.nn.Module):
+            return model
+
+        if model not in self._prepared_models:
+            self._prepared_models[model] = copy.deepcopy(model).to(memory_format=torch.channels_last)
+        return self._prepared_models[model]
+
+    def prepare_input(self, img):
+        return img.contiguous(memory_format=torch.channels_last) if self.channels_last else img
+
+    def use_autocast(self, model, sample):
+        """
+        Whether to run model under autocast, checked against float32 on sample the first time a model is seen
+        """
+        if self.autocast_dtype is None:
+            return False
+
+        if model not in self._autocast_models:
+            enabled = is_autocast_supported(model.device, self.autocast_dtype)
+            if not enabled:
+                print(f"[Warning] Autocast with {self.autocast_dtype} is not supported on {model.device}; "
+                      f"use float32 instead.")
+            elif self.tolerance is not None:
+                error = compare_autocast_with_float32(model, sample, self)
+                enabled = error <= self.tolerance
+                if not enabled:
+                    print(f"[Warning] Autocast with {self.autocast_dtype} deviates from float32 by {error:.4f} "
+                          f"(tolerance: {self.tolerance}); use float32 instead.")
+            self._autocast_models[model] = enabled
+
+        return self._autocast_models[model]
+
+
+@traced
+def _forward(model, img, inference_config, autocast=False, margin=0):
+    # positive class probabilities of a batch
+    with inference_config.autocast_context(model.device, enabled=autocast):
+        output = model(inference_config.prepare_input(img))
+    output = torch.nn.functional.softmax(output.float(), dim=1)
+    output = output[..., margin:output.shape[-2] - margin, margin:output.shape[-1] - margin]
+    return output.detach().cpu().numpy()[:, 1, ...]
+
+
+def compare_autocast_with_float32(model, sample, inference_config):
+    """
+    Maximal absolute difference of positive class probabilities
+    between the autocast and the float32 outputs of model on a sample batch
+    """
+    with inference_config.grad_context():
+        reference = _forward(model, sample, inference_config, autocast=False)
+        output = _forward(model, sample, inference_config, autocast=True)
+    return float(np.abs(output - reference).max()) if output.size else 0.
+
+
+def predict_with_model(model: LightningModule, dataloader, margin=0, inference_config=None, recorder=None):
     """
     Generating predictions using model
 
@@ -74,27 +467,215 @@ def predict_with_model(model: LightningModule, dataloader):
     ----------
     model
     dataloader
+    margin : int
+        border discarded on each side of every output, e.g., the halo of tiles
+    inference_config : InferenceConfig or None
+        how the model is run; use the default config if None
+    recorder : StageRecorder or None
+        if not None, record every batch through the model as "forward"
 
     Returns
     -------
 
     """
-    model_output = []
-    device = model.device
+    return predict_with_models([model], dataloader, margin=margin, inference_config=inference_config,
+                               recorder=recorder)[0]
 
-    for img, *_ in dataloader:
-        img_ = img.to(device) if img.device != device else img
-        output = model(img_)
-        output = torch.nn.functional.softmax(output, dim=1)
-        model_output.append(output.detach().cpu().numpy()[:, 1, ...])
 
-    model_output = list(chain.from_iterable(model_output))  # remove the batch axis
-    model_output = np.array(model_output)
+@traced
+def predict_with_models(models: List[LightningModule], dataloader, margin=0, inference_config=None, recorder=None):
+    """
+    Generating predictions using several models over the same batches,
+    so that every batch is only loaded and moved to device once
 
-    return model_output
+    Parameters
+    ----------
+    models : List[LightningModule]
+        models sharing the same input geometry
+    dataloader : iterable
+        batches of patches
+    margin : int
+        border discarded on each side of every output, e.g., the halo of tiles
+    inference_config : InferenceConfig or None
+        how models are run; use the default config if None
+    recorder : StageRecorder or None
+        if not None, record every batch through every model as "forward"
 
+    Returns
+    -------
+    model_outputs : List[np.array]
+        positive class probabilities of every model, in the same order as models
+    """
+    inference_config = InferenceConfig() if inference_config is None else inference_config
+    recorder = get_stage_recorder(recorder)
+    models = [inference_config.prepare_model(model) for model in models]
 
-def generate_heatmap(size, output, extractor: Extractor, output_coords=None, threshold=0.5):
+    model_outputs = [[] for _ in models]
+
+    with inference_config.grad_context():
+        for img, *_ in dataloader:
+            for model, model_output in zip(models, model_outputs):
+                device = model.device
+                img_ = img.to(device) if img.device != device else img
+                autocast = inference_config.use_autocast(model, img_)
+                with recorder.stage("forward", patches=len(img_)):
+                    model_output.append(_forward(model, img_, inference_config, autocast=autocast, margin=margin))
+
+    # remove the batch axis
+    return [np.array(list(chain.from_iterable(model_output))) for model_output in model_outputs]
+
+
+def get_blending_weights(patch_size, blend="max"):
+    """
+    Weights of every pixel in a patch used for blending overlapping patches
+
+    Parameters
+    ----------
+    patch_size : int or tuple(int, int)
+        (height, width) of a patch, or a single int for square patches
+    blend : str
+        one of "max", "mean" or "weighted";
+        "weighted" uses a tent window, so that pixels near the patch center,
+        which have more context, contribute more than those near the borders
+
+    Returns
+    -------
+    weights : np.array with shape (height, width), float32
+    """
+    height, width = (patch_size, patch_size) if np.isscalar(patch_size) else patch_size
+    if blend != "weighted":
+        return np.ones((height, width), dtype=np.float32)
+
+    def tent(length):
+        window = 1 - np.abs(np.linspace(-1, 1, length + 2)[1:-1])
+        return window.astype(np.float32)
+
+    return np.outer(tent(height), tent(width))
+
+
+def _group_non_overlapping_patches(coords, patch_height, patch_width, max_groups=64):
+    # patches on a regular grid are split by their phase on the grid,
+    # so that patches in every group never overlap with each other and
+    # form a coarser grid, i.e., blocks of a strided view of the canvas
+    relative_coords = coords - coords.min(axis=0)
+    strides = np.gcd.reduce(relative_coords, axis=0)
+    patch_sizes = (patch_width, patch_height)
+    periods = [int(np.ceil(size / stride)) if stride > 0 else 1
+               for size, stride in zip(patch_sizes, strides)]
+
+    if periods[0] * periods[1] > max_groups:
+        return None
+
+    # distance between two adjacent blocks of a group on every axis
+    steps = np.array([period * stride if stride > 0 else size
+                      for period, stride, size in zip(periods, strides, patch_sizes)])
+    grid_ids = relative_coords // np.maximum(strides, 1)
+    group_ids = (grid_ids[:, 1] % periods[1]) * periods[0] + grid_ids[:, 0] % periods[0]
+
+    groups = []
+    for group_id in np.unique(group_ids):
+        group = np.flatnonzero(group_ids == group_id)
+        origin = coords[group].min(axis=0)
+        block_ids = (coords[group] - origin) // steps
+        groups.append((group, origin, steps, block_ids))
+    return groups
+
+
+def _blocks_view(canvas, origin, steps, block_counts, patch_height, patch_width):
+    # writable view of the canvas with shape (block_rows, block_cols, patch_height, patch_width);
+    # blocks never overlap, so writing through the view is safe
+    row_stride, col_stride = canvas.strides
+    return np.lib.stride_tricks.as_strided(canvas[origin[1]:, origin[0]:],
+                                           shape=(block_counts[1], block_counts[0], patch_height, patch_width),
+                                           strides=(steps[1] * row_stride, steps[0] * col_stride,
+                                                    row_stride, col_stride))
+
+
+@traced
+def stitch_patches(output, output_coords, size, blend="max"):
+    """
+    Stitch outputs of overlapping patches into one canvas
+
+    Parameters
+    ----------
+    output : np.array with shape (n, patch_height, patch_width)
+        model outputs for every patch
+    output_coords : array-like with shape (n, 2)
+        (x, y) coordinates of the upper left corner of every patch;
+        can be negative or out of the canvas, e.g., with mirror padding
+    size : tuple(int, int)
+        (width, height) of the canvas
+    blend : str
+        how overlapping pixels are combined, one of "max", "mean" or "weighted";
+        see get_blending_weights for details
+
+    Returns
+    -------
+    canvas : np.array with shape (height, width), float32
+        stitched outputs; pixels not covered by any patch are 0
+    """
+    assert blend in ("max", "mean", "weighted"), f"Unknown blending method {blend}."
+    width, height = size
+    output = np.asarray(output, dtype=np.float32)
+
+    if len(output) == 0:
+        return np.zeros((height, width), dtype=np.float32)
+
+    coords = np.asarray(output_coords, dtype=np.int64).reshape(-1, 2)
+    _, patch_height, patch_width = output.shape
+
+    # allocate a canvas large enough for every patch, and crop it in the end
+    origin = np.minimum(coords.min(axis=0), 0)
+    end = np.maximum(coords.max(axis=0) + [patch_width, patch_height], [width, height])
+    canvas_width, canvas_height = end - origin
+    coords = coords - origin
+
+    canvas = np.zeros((canvas_height, canvas_width), dtype=np.float32)
+    weight_canvas = np.zeros_like(canvas) if blend != "max" else None
+    weights = get_blending_weights((patch_height, patch_width), blend)
+
+    groups = _group_non_overlapping_patches(coords, patch_height, patch_width)
+
+    if groups is None:
+        # irregular coordinates; fall back to unbuffered operations
+        rows = (coords[:, 1, np.newaxis] + np.arange(patch_height))[:, :, np.newaxis]
+        cols = (coords[:, 0, np.newaxis] + np.arange(patch_width))[:, np.newaxis, :]
+        if blend == "max":
+            np.maximum.at(canvas, (rows, cols), output)
+        else:
+            np.add.at(canvas, (rows, cols), output * weights)
+            np.add.at(weight_canvas, (rows, cols), np.broadcast_to(weights, output.shape))
+    else:
+        for group, group_origin, steps, block_ids in groups:
+            block_counts = block_ids.max(axis=0) + 1
+            blocks = _blocks_view(canvas, group_origin, steps, block_counts, patch_height, patch_width)
+
+            if len(group) == np.prod(block_counts):
+                # every block is covered; update the whole view in place
+                block_index = (slice(None), slice(None))
+                group = group[np.lexsort((block_ids[:, 0], block_ids[:, 1]))]
+                group_output = output[group].reshape(blocks.shape)
+            else:
+                block_index = block_ids[:, 1], block_ids[:, 0]
+                group_output = output[group]
+
+            if blend == "max":
+                blocks[block_index] = np.maximum(blocks[block_index], group_output)
+            else:
+                blocks[block_index] += group_output * weights
+                weight_blocks = _blocks_view(weight_canvas, group_origin, steps, block_counts,
+                                             patch_height, patch_width)
+                weight_blocks[block_index] += weights
+
+    if blend != "max":
+        np.divide(canvas, weight_canvas, out=canvas, where=weight_canvas > 0)
+
+    return canvas[-origin[1]:-origin[1] + height, -origin[0]:-origin[0] + width]
+
+
+@traced
+def generate_heatmap(size, output, extractor: Extractor, output_coords=None, threshold=0.5, blend="max",
+                     model_resolution=False):
     width, height = size
     resized_width, resized_height = int(width * extractor.resize), int(height * extractor.resize)
 
@@ -107,20 +688,17 @@ def generate_heatmap(size, output, extractor: Extractor, output_coords=None, thr
 
     assert len(output_coords) == len(output), f"{len(output_coords)} != {len(output)}."
 
-    heatmap = Image.new("L", (resized_width, resized_height))
-
-    for output_prob, (x, y) in zip(output, output_coords):
-        existing_area = np.array(heatmap.crop((x, y, x + output_prob.shape[0], y + output_prob.shape[1])))
-        # output_prob *= 255
-        output_prob[output_prob < threshold] = 0
-        output_prob *= 255
+    heatmap = stitch_patches(output, output_coords, (resized_width, resized_height), blend=blend)
 
-        paste_area = np.maximum(existing_area, output_prob)
-        paste_area = Image.fromarray(paste_area)
-        paste_coordinates = x, y
-        heatmap.paste(paste_area, paste_coordinates)
+    # thresholding the max of all patches is the same as taking
+    # the max of thresholded patches, so it's applied only once here
+    heatmap[heatmap < threshold] = 0
+    heatmap *= 255
+    heatmap = Image.fromarray(heatmap.astype(np.uint8))
 
-    heatmap = heatmap.resize((width, height), resample=Image.NEAREST)
+    # at model resolution, the heatmap is (int(width * extractor.resize), int(height * extractor.resize))
+    if not model_resolution:
+        heatmap = heatmap.resize((width, height), resample=Image.NEAREST)
 
     return heatmap
 
@@ -131,9 +709,10 @@ def generate_heatmap(size, output, extractor: Extractor, output_coords=None, thr
 
 
 def get_latest_model_from_dir(model_root,
-                              timestamp_format="%Y-%m-%dT%H:%M:%S"):
+                              timestamp_format="%Y-%m-%dT%H:%M:%S",
+                              suffix=".ckpt"):
     model_paths = []
-    for path in Path(model_root).glob("*.ckpt"):
+    for path in Path(model_root).glob(f"*{suffix}"):
         try:
             ts = datetime.strptime(path.name, timestamp_format)
         except ValueError:
@@ -144,192 +723,616 @@ def get_latest_model_from_dir(model_root,
     return None if not model_paths else model_paths[0][0].resolve()
 
 
-def load_label_info_from_config(config_file):
+def get_latest_model_of_section(config_file, section):
+    """
+    Backend and path of the latest model of a class section in the config file, or None if there's no model
+    """
+    model_root = Path(config_file).parent / Path(section["model_root"])
+    backend = section.get("backend", "torch")
+    if backend not in model_backends:
+        raise ValueError(f"Unknown backend '{backend}' of {section.name}; "
+                         f"should be one of {list(model_backends)}.")
+    return backend, get_latest_model_from_dir(model_root / section.name, suffix=model_backends[backend][0])
+
+
+@traced
+def load_label_info_from_config(config_file, model_registry=None, drop_missing_models=True):
+    """
+    Load class labels, attributes and the latest model of every class from a config file
+
+    Parameters
+    ----------
+    config_file : str or Path
+        the config .ini file, e.g., ml_core/label_info.ini
+    model_registry : ml_core.modeling.registry.ModelRegistry or None
+        if not None, models are taken from this cache and only loaded when they are new or updated
+    drop_missing_models : bool
+        if True, drop classes without any model; otherwise keep them with None as model
+
+    Returns
+    -------
+    label_info : pd.DataFrame
+        class labels, models and other attributes
+    """
     config = configparser.ConfigParser()
     config.read(config_file)
     label_info = pd.DataFrame()
     for section_name in config.sections():
         section = config[section_name]
-        model_root = Path(config_file).parent / Path(config[section_name]["model_root"])
-        model_path = get_latest_model_from_dir(model_root / section_name)
+        backend, model_path = get_latest_model_of_section(config_file, section)
+        section["backend"] = backend
         section["model_path"] = str(model_path)
         section["label_name"] = section_name
         section["extractor_config_name"] = f"AAPI_{section_name}"
         label_info = label_info.append(dict(section), ignore_index=True)
 
-    label_info["model"] = label_info["model_path"].apply(load_model_from_checkpoint)
+    def load_model(backend, model_path):
+        loader = model_backends[backend][1]
+        return loader(model_path) if model_registry is None else model_registry.get(model_path, loader)
+
+    label_info["model"] = [load_model(backend, model_path)
+                           for backend, model_path in zip(label_info["backend"], label_info["model_path"])]
     label_info["label"] = label_info["label"].apply(int)
     label_info["min_size"] = label_info["min_size"].apply(int)
     label_info["threshold"] = label_info["threshold"].apply(float)
-    label_info = label_info.dropna()
+    if drop_missing_models:
+        label_info = label_info.dropna()
+    else:
+        label_info = label_info.dropna(subset=label_info.columns.drop("model"))
     return label_info
 
 
+def group_label_info_by_extractor(label_info, resize_factor=1):
+    """
+    Group classes whose extractors share the same geometry,
+    so that patches are only extracted once for every group
+
+    Parameters
+    ----------
+    label_info : pd.DataFrame
+        class labels and attributes, including "extractor_config_name"
+    resize_factor : float
+        factor multiplied to the resize factor of every extractor,
+        e.g., to accommodate the level of input images
+
+    Returns
+    -------
+    groups : List[Tuple[Extractor, List[Tuple[int, namedtuple]]]]
+        extractor of every group, and (layer_index, row) of every class in the group,
+        where layer_index is the position of the row in label_info
+    """
+    groups = {}
+    for layer_index, row in enumerate(label_info.itertuples()):
+        extractor = Extractor(config_section_name=row.extractor_config_name)
+        extractor.resize = extractor.resize * resize_factor
+
+        geometry = (extractor.resize, extractor.patch_size, extractor.stride_size, extractor.mirror_pad_size)
+        if geometry not in groups:
+            groups[geometry] = (extractor, [])
+        groups[geometry][1].append((layer_index, row))
+
+    return list(groups.values())
+
+
+@traced
+def generate_enhanced_heatmap(outputs,
+                              heatmap_size,
+                              extractor,
+                              threshold,
+                              output_coords=None,
+                              blend="max",
+                              recorder=None,
+                              morphology_workers=1,
+                              model_resolution=False):
+    recorder = get_stage_recorder(recorder)
+    pixels = heatmap_size[0] * heatmap_size[1]
+
+    with recorder.stage("stitch", patches=len(outputs), pixels=pixels):
+        heatmap: Image = generate_heatmap(heatmap_size, outputs, extractor,
+                                          output_coords=output_coords,
+                                          threshold=threshold,
+                                          blend=blend,
+                                          model_resolution=model_resolution)
+        heatmap: np.ndarray = np.array(heatmap)
+        pixels = heatmap.size
+
+    with recorder.stage("morphology", pixels=pixels):
+        heatmap = enhance_heatmap_by_tiles(heatmap, workers=morphology_workers)
+    return heatmap
+
+
+@traced
 def predict_on_single_ROI(model,
                           data,
                           heatmap_size,
                           extractor,
                           threshold,
-                          output_coords=None):
-
-    outputs = predict_with_model(model, data)
-    heatmap: Image = generate_heatmap(heatmap_size, outputs, extractor,
-                               output_coords=output_coords,
-                               threshold=threshold)
-    heatmap: np.ndarray = np.array(heatmap)
-    binary_enhanced_heatmap = enhance_heatmap(heatmap)
-    heatmap[np.where(binary_enhanced_heatmap == 0)] &= 0
-    return heatmap
+                          output_coords=None,
+                          blend="max",
+                          margin=0,
+                          inference_config=None,
+                          morphology_workers=1):
 
+    outputs = predict_with_model(model, data, margin=margin, inference_config=inference_config)
+    return generate_enhanced_heatmap(outputs, heatmap_size, extractor, threshold,
+                                     output_coords=output_coords,
+                                     blend=blend,
+                                     morphology_workers=morphology_workers)
 
+
+class RunningArgmax:
+    """
+    Multi-class mask of a ROI, aggregated class by class from uint8 heatmaps,
+    keeping only the best score and the layer of the best class for every pixel,
+    so that memory doesn't grow with the number of classes
+    """
+
+    def __init__(self, size, layer_mapping):
+        """
+        Parameters
+        ----------
+        size : Tuple[int, int]
+            (width, height) of the ROI
+        layer_mapping : List[int]
+            label of every layer, layer 0 being the background
+        """
+        width, height = size
+        self.best_scores = np.zeros((height, width), dtype=np.uint8)
+        self.best_layers = np.zeros((height, width), dtype=np.uint8)
+        self.label_lookup = np.array(layer_mapping, dtype=np.min_scalar_type(max(layer_mapping)))
+
+    def update(self, layer, heatmap):
+        """
+        Add the heatmap of a class, in any order of layers;
+        ties go to the lowest layer, as in np.argmax over all layers
+        """
+        better = heatmap > self.best_scores
+        better |= (heatmap == self.best_scores) & (self.best_layers > layer)
+        self.best_scores[better] = heatmap[better]
+        self.best_layers[better] = layer
+
+    def to_mask(self):
+        return self.label_lookup[self.best_layers]
+
+
+def _chunk_ROIs_by_patch_count(ROIs, extractor_groups, max_pooled_patches):
+    # greedily group consecutive ROIs, so that patches of every chunk
+    # can be pooled into full batches without exceeding the budget
+    chunks, chunk, chunk_patch_count = [], [], 0
+
+    for ROI_id, ROI in enumerate(ROIs):
+        width, height = ROI.size
+        patch_count = max(len(generate_patches_coords(int(width * extractor.resize),
+                                                      int(height * extractor.resize),
+                                                      extractor.patch_size,
+                                                      extractor.stride_size,
+                                                      extractor.mirror_pad_size))
+                          for extractor, _ in extractor_groups)
+
+        if chunk and chunk_patch_count + patch_count > max_pooled_patches:
+            chunks.append(chunk)
+            chunk, chunk_patch_count = [], 0
+
+        chunk.append(ROI_id)
+        chunk_patch_count += patch_count
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+@traced
 def predict_on_batch_ROIs(ROIs,
                           upper_left_coords,
                           label_info,
                           batch_size=64,
                           verbose=False,
                           input_ROI_level=0,
-                          level_base=4):
+                          level_base=4,
+                          fully_convolutional=False,
+                          memory_budget=1024 ** 3,
+                          skip_background=True,
+                          cross_ROI_batching=False,
+                          max_pooled_patches=4096,
+                          inference_config=None,
+                          polygonize_workers=1,
+                          morphology_workers=1,
+                          callback=None):
+    """
+    Produce masks and annotations for every ROI
+
+    Parameters
+    ----------
+    ROIs : List[PIL.Image]
+        list of region-of-interest
+    upper_left_coords : List[Tuple]
+        upper left coordinates for every ROI on level 0
+    label_info : pd.DataFrame
+        class labels, models and other attributes
+    batch_size : int
+        batch size used for inference
+    verbose : bool
+        if True, show a progress bar
+    input_ROI_level : int
+        level of the input ROIs
+    level_base : int
+        downsampling factor between every two adjacent levels
+    fully_convolutional : bool
+        if True, run models on large overlapping tiles and keep only the interior of every tile,
+        instead of sliding patches over the ROI, which computes every pixel many times;
+        only models of the "torch" and "slim" backends are supported
+    memory_budget : int
+        only used when fully_convolutional is True;
+        bytes of activations available to a tile, which decides the tile size
+    skip_background : bool
+        if True, patches without tissue are not sent to models and left as background;
+        only used in sliding patches mode
+    cross_ROI_batching : bool
+        if True, patches of consecutive ROIs are pooled into the same batches,
+        so that small ROIs don't produce underfilled batches
+    max_pooled_patches : int
+        only used when cross_ROI_batching is True;
+        upper bound of patches pooled at once, which bounds the memory of pooled patches and outputs
+    inference_config : InferenceConfig or None
+        how models are run, e.g., precision and memory format; use the default config if None
+    polygonize_workers : int
+        number of threads polygonizing every mask, see ml_core.utils.annotations.mask_to_annotation
+    morphology_workers : int
+        number of threads opening tiles of every heatmap, see enhance_heatmap_by_tiles
+    callback : StageRecorder or callable or List[callable] or None
+        sinks receiving start and stop events of every stage, see ml_core.utils.profiling
+
+    Returns
+    -------
+    predicted_masks : List[np.array]
+        multi-class mask for every ROI
+    annotations : List[List[ASAPAnnotation]]
+        annotations for every ROI
+    """
+    recorder = get_stage_recorder(callback)
     annotations = []
     predicted_masks = []
 
-    ROI_iter = zip(ROIs, upper_left_coords)
-    if verbose:
-        ROI_iter = tqdm(ROI_iter, total=len(ROIs))
-
     resize_factor = (level_base ** input_ROI_level)
     label_info["min_area"] = label_info["min_size"] // resize_factor
+    layer_mapping = [0] + label_info["label"].to_list()
+
+    # resize factor in extractor is based on level 0
+    # to accommodate input level, should times the level zoom factor (4 as default)
+    extractor_groups = group_label_info_by_extractor(label_info, resize_factor)
+
+    if cross_ROI_batching:
+        ROI_chunks = _chunk_ROIs_by_patch_count(ROIs, extractor_groups, max_pooled_patches)
+    else:
+        ROI_chunks = [[ROI_id] for ROI_id in range(len(ROIs))]
+
+    progress_bar = tqdm(total=len(ROIs)) if verbose else None
+
+    for ROI_chunk in ROI_chunks:
+        # infer every chunk of ROIs
+        chunk_ROIs = [ROIs[ROI_id] for ROI_id in ROI_chunk]
+        with recorder.stage("aggregate", pixels=sum(ROI.size[0] * ROI.size[1] for ROI in chunk_ROIs)):
+            aggregators = [RunningArgmax(ROI.size, layer_mapping) for ROI in chunk_ROIs]
+
+        # predict for every group of classes sharing the same patches
+        for extractor, rows in extractor_groups:
+            models = [row.model for _, row in rows]
+            for model in models:
+                model.freeze()
+
+            if fully_convolutional:
+                # keep the same minimal context as the best centered patch in sliding mode
+                halo = (extractor.patch_size - extractor.stride_size) // 2
+                max_image_side = max(int(max(ROI.size) * extractor.resize) for ROI in chunk_ROIs)
+                tile_size = min(estimate_tile_size(model, memory_budget, halo=halo, max_image_side=max_image_side)
+                                for model in models)
+                with recorder.stage("patch_crop") as counts:
+                    inputs = [extractor.extract_tiles(ROI, tile_size, halo) for ROI in chunk_ROIs]
+                    counts["patches"] = sum(len(p) for p, _ in inputs)
+                input_batch_size = 1
+            else:
+                halo = 0
+                with recorder.stage("patch_crop") as counts:
+                    inputs = [extract_inference_patches_from_ROI(ROI, extractor, tissue_only=skip_background)
+                              for ROI in chunk_ROIs]
+                    counts["patches"] = sum(len(p) for p, _ in inputs)
+                input_batch_size = batch_size
+
+            # pool patches of all ROIs in the chunk, and keep track of their owners
+            with recorder.stage("tensorize", patches=sum(len(p) for p, _ in inputs)):
+                patches = np.concatenate([p for p, _ in inputs]) if len(inputs) > 1 else inputs[0][0]
+                split_indices = np.cumsum([len(p) for p, _ in inputs])[:-1]
+                data = construct_inference_dataloader_from_patches(patches, input_batch_size)
+                del patches
+
+            outputs = predict_with_models(models, data, margin=halo, inference_config=inference_config,
+                                          recorder=recorder)
+
+            for (layer_index, row), output in zip(rows, outputs):
+                for ROI, aggregator, ROI_output, (_, output_coords) in zip(chunk_ROIs,
+                                                                          aggregators,
+                                                                          np.split(output, split_indices),
+                                                                          inputs):
+                    heatmap = generate_enhanced_heatmap(ROI_output,
+                                                        heatmap_size=ROI.size,
+                                                        extractor=extractor,
+                                                        threshold=row.threshold,
+                                                        output_coords=output_coords,
+                                                        recorder=recorder,
+                                                        morphology_workers=morphology_workers)
+
+                    with recorder.stage("aggregate", pixels=heatmap.size):
+                        aggregator.update(layer_index + 1, heatmap)
+
+            del data, outputs, inputs
+
+        for ROI_id, aggregator in zip(ROI_chunk, aggregators):
+            with recorder.stage("aggregate", pixels=aggregator.best_layers.size):
+                mask = aggregator.to_mask()
+
+            with recorder.stage("polygonize", pixels=mask.size) as counts:
+                annotation = mask_to_annotation(mask, label_info, upper_left_coords[ROI_id], mask_level=0,
+                                                workers=polygonize_workers)
+                counts["polygons"] = len(annotation)
+
+            annotations.append(annotation)
+            predicted_masks.append(mask)
+
+        del aggregators
+        if progress_bar is not None:
+            progress_bar.update(len(ROI_chunk))
+
+    if progress_bar is not None:
+        progress_bar.close()
 
-    for ROI, upper_left in ROI_iter:
-        # infer every ROI
-        # coordinate_pattern = re.compile(r".*ROI_(\(\d+,[ ]?\d+\)).*")
-        # match = re.match(coordinate_pattern, str(ROI_path))
+    return predicted_masks, annotations
 
-        # upper_left = eval(match.group(1))
-        # assert type(upper_left) == tuple, f"Match Failed with {upper_left}."
-        width, height = ROI.size
-        agg_heatmap = np.zeros((height, width, len(label_info) + 1)) # add a layer for background
-        layer_mapping = [0] + label_info["label"].to_list()
 
-        # annotation = []
-        # predicted_mask = []
+@traced
+def detect_biopsies_on_WSI(thumbnail, level_base=4):
+    """
+    Detect biopsy contours from a thumbnail at level 2, and remap them to level 1 coordinates
+    """
+    biopsy_contours: List[Polygon] = get_biopsy_contours(thumbnail)
+    return [affine_transform(c, [level_base, 0, 0, level_base, 0, 0]) for c in biopsy_contours]
 
-        # predict for every class
-        for layer_index, row in enumerate(label_info.itertuples()):
-            extractor = Extractor(config_section_name=row.extractor_config_name)
-            # resize factor in extractor is based on level 0
-            # to accommodate input level, should times the level zoom factor (4 as default)
-            extractor.resize = extractor.resize * resize_factor
 
-            model = row.model
-            model.freeze()
+@traced
+def read_slide_and_detect_biopsies(slide_path, level_base=4, streaming=False, tile_size=2048, recorder=None):
+    """
+    Open a slide and detect its biopsies on level 1; in streaming mode, the thumbnail of detection
+    is read strip by strip, yet it's equal to the resized full level 1 image used without streaming,
+    so that biopsies, and so bounding boxes, don't depend on streaming
 
-            data = construct_inference_dataloader_from_ROI(ROI=ROI,
-                                                                 extractor=extractor,
-                                                                 batch_size=batch_size)
+    Returns
+    -------
+    slide : openslide.OpenSlide
+        the opened slide
+    whole_slide_level_1 : PIL.Image or None
+        the full level 1 image, or None in streaming mode
+    biopsy_contours : List[Polygon]
+        biopsy contours in level 1 coordinates
+    """
+    recorder = get_stage_recorder(recorder)
 
-            heatmap = predict_on_single_ROI(model,
-                                            data,
-                                            heatmap_size=ROI.size,
-                                            extractor=extractor,
-                                            threshold=row.threshold,
-                                            output_coords=None)
+    with recorder.stage("slide_read") as counts:
+        slide = read_slide(slide_path)
+        level_1_width, level_1_height = slide.level_dimensions[1]
+        whole_slide_level_1 = None
+        if not streaming:
+            whole_slide_level_1: Image = read_region_from_slide(slide, 0, 0, 1, level_1_width, level_1_height)
+            counts["pixels"] = level_1_width * level_1_height
 
-            agg_heatmap[..., layer_index + 1] = heatmap
+    with recorder.stage("thumbnail", pixels=level_1_width // level_base * level_1_height // level_base):
+        if streaming:
+            thumbnail = read_level_thumbnail(slide, 1, level_base, tile_size=tile_size)
+        else:
+            thumbnail = whole_slide_level_1.resize((level_1_width // level_base, level_1_height // level_base))
 
-            # mask = np.zeros_like(heatmap)
-            # mask[heatmap != 0] = row.label
+    with recorder.stage("biopsy_detection") as counts:
+        biopsy_contours = detect_biopsies_on_WSI(thumbnail, level_base)
+        counts["biopsies"] = len(biopsy_contours)
 
-            # min_area = row.min_size // (level_base ** input_ROI_level)
-            # annotation.extend(mask_to_annotation(mask, label_info, upper_left, mask_level=0, min_area=min_area))
-            # predicted_mask.append(mask)
+    return slide, whole_slide_level_1, biopsy_contours
 
-        mask = np.argmax(agg_heatmap, axis=2).squeeze()
-        for layer, label in enumerate(layer_mapping):
-            if layer != 0 and label != 0:
-                mask[mask == layer] = label
 
-        annotation = mask_to_annotation(mask, label_info, upper_left, mask_level=0)
+def get_biopsy_bbox(biopsy_contour):
+    # integer bounding box (minx, miny, maxx, maxy) of a biopsy on level 1;
+    # contours of detect_biopsies_on_WSI are pixel coordinates times level_base, so it equals their bounds
+    return tuple(int(round(b)) for b in biopsy_contour.bounds)
 
-        annotations.append(annotation)
-        predicted_masks.append(mask)
 
-    return predicted_masks, annotations
+@traced
+def get_biopsy_patches_coords(biopsy_contour, extractor):
+    """
+    Coordinates of patches covering a biopsy, in the resized frame of the extractor,
+    relative to the upper left corner of the biopsy bounding box
+    """
+    bbox = get_biopsy_bbox(biopsy_contour)
+    width, height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+    resized_width, resized_height = int(width * extractor.resize), int(height * extractor.resize)
+
+    resized_contour = affine_transform(biopsy_contour, [1, 0, 0, 1, -bbox[0], -bbox[1]])
+    resized_contour = affine_transform(resized_contour, [extractor.resize, 0, 0, extractor.resize, 0, 0])
 
+    # resize level: same as resized_contour
+    # origin point: upper left of resized_contour
+    return get_biopsy_covered_patches_coords(resized_contour,
+                                             resized_width,
+                                             resized_height,
+                                             extractor.patch_size,
+                                             extractor.stride_size,
+                                             0)
 
+
+@traced
+def postprocess_biopsy_output(output, output_coords, biopsy_contour, extractor, row, label_info, level_base=4,
+                              recorder=None, polygonize_workers=1, morphology_workers=1, model_resolution=False):
+    """
+    Turn model outputs of one class on a biopsy into a mask and annotations;
+    if model_resolution is True, the heatmap isn't resized to level 1, so that morphology and polygonization
+    run on extractor.resize times fewer pixels on each side, and only polygons are scaled to level 0
+
+    Returns
+    -------
+    mask : np.array
+        mask of the biopsy bounding box on level 1, or at model resolution, with row.label for positive pixels
+    annotations : List[ASAPAnnotation]
+        annotations in level 0 coordinates
+    """
+    bbox = get_biopsy_bbox(biopsy_contour)
+    width, height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+
+    recorder = get_stage_recorder(recorder)
+    heatmap = generate_enhanced_heatmap(output, (width, height), extractor,
+                                        threshold=row.threshold,
+                                        output_coords=output_coords,
+                                        recorder=recorder,
+                                        morphology_workers=morphology_workers,
+                                        model_resolution=model_resolution)
+
+    with recorder.stage("aggregate", pixels=heatmap.size):
+        mask = np.zeros_like(heatmap)
+        mask[heatmap != 0] = row.label
+
+    min_area = row.min_size // level_base
+
+    with recorder.stage("polygonize", pixels=mask.size) as counts:
+        annotations = mask_to_annotation(mask,
+                                         label_info,
+                                         (bbox[0] * level_base, bbox[1] * level_base),
+                                         mask_level=1,
+                                         min_area=min_area,
+                                         level_factor=level_base,
+                                         workers=polygonize_workers,
+                                         mask_downsample=(width / mask.shape[1], height / mask.shape[0]))
+        counts["polygons"] = len(annotations)
+    return mask, annotations
+
+
+@traced
 def predict_on_WSI(slide_path,
                    label_info,
                    batch_size=64,
                    level_base=4,
-                   callback=None):
+                   callback=None,
+                   streaming=False,
+                   tile_size=2048,
+                   inference_config=None,
+                   polygonize_workers=1,
+                   morphology_workers=1,
+                   model_resolution_masks=False):
+    """
+    Produce annotations for every biopsy detected in a slide
 
-    whole_slide_level_1: Image = read_full_slide_by_level(slide_path, level=1)
-    level_1_width, level_1_height = whole_slide_level_1.size
-    thumbnail = whole_slide_level_1.resize((level_1_width // level_base, level_1_height // level_base))
+    Parameters
+    ----------
+    slide_path : str or Path
+        path to the slide
+    label_info : pd.DataFrame
+        class labels, models and other attributes
+    batch_size : int
+        batch size used for inference
+    level_base : int
+        downsampling factor between every two adjacent levels
+    callback : StageRecorder or callable or List[callable] or None
+        sinks receiving start and stop events of every stage, with counts of patches, pixels, polygons, etc.;
+        see ml_core.utils.profiling for the stages and the available sinks
+    streaming : bool
+        if True, patches are read tile by tile from the slide at the level matching the
+        resize factor of every class, instead of loading the full level 1 image in memory
+    tile_size : int
+        only used in streaming mode; side length of the tiles read from the slide
+        (in the resized frame), which bounds the size of every read
+    inference_config : InferenceConfig or None
+        how models are run, e.g., precision and memory format; use the default config if None
+    polygonize_workers : int
+        number of threads polygonizing the mask of every biopsy and class,
+        see ml_core.utils.annotations.mask_to_annotation
+    morphology_workers : int
+        number of threads opening tiles of the heatmap of every biopsy and class, see enhance_heatmap_by_tiles
+    model_resolution_masks : bool
+        if True, heatmaps of every class stay at the resolution the model ran at instead of being resized
+        to level 1, which divides the pixels of morphology and polygonization by the square of the resize factor;
+        masks are then returned at model resolution, and morphology works on coarser pixels
 
-    biopsy_contours: List[Polygon] = get_biopsy_contours(thumbnail)
-    # remap to level 1 coordinates
-    biopsy_contours = [affine_transform(c, [level_base, 0, 0, level_base, 0, 0]) for c in biopsy_contours]
+    Returns
+    -------
+    predicted_masks : List[List[np.array]]
+        masks for every biopsy, one for each class in label_info
+    annotations : List[List[ASAPAnnotation]]
+        annotations for every biopsy
+    """
+    recorder = get_stage_recorder(callback)
+
+    slide, whole_slide_level_1, biopsy_contours = read_slide_and_detect_biopsies(slide_path, level_base,
+                                                                                 streaming=streaming,
+                                                                                 tile_size=tile_size,
+                                                                                 recorder=recorder)
 
     annotations = [[] for _ in range(len(biopsy_contours))]
     predicted_masks = [[] for _ in range(len(biopsy_contours))]
 
-    for biopsy_id, biopsy_contour in enumerate(tqdm(biopsy_contours)):
-
-        bbox = biopsy_contour.bounds
-
-        maxx_level_0 = bbox[0] * level_base
-        maxy_level_0 = bbox[1] * level_base
-
-        ROI: Image = whole_slide_level_1.crop(bbox)
-        width, height = ROI.size
-
-        for layer_index, row in enumerate(label_info.itertuples()):
-            extractor = Extractor(config_section_name=row.extractor_config_name)
-            extractor.resize = extractor.resize * level_base  # change level from 0 to 1
-
-            resized_width, resized_height = int(width * extractor.resize), int(height * extractor.resize)
-            resized_ROI = ROI.resize((resized_width, resized_height))
-
-            resized_contour = affine_transform(biopsy_contour, [1, 0, 0, 1, -bbox[0], -bbox[1]])
-            resized_contour = affine_transform(resized_contour, [extractor.resize, 0, 0, extractor.resize, 0, 0])
-
-            # resize level: same as resized_contour
-            # origin point: upper left of resized_contour
-            covered_coords = get_biopsy_covered_patches_coords(resized_contour,
-                                                               resized_width,
-                                                               resized_height,
-                                                               extractor.patch_size,
-                                                               extractor.stride_size,
-                                                               0)
-
-            patches = [resized_ROI.crop((coord[0],
-                                         coord[1],
-                                         coord[0] + extractor.patch_size,
-                                         coord[1] + extractor.patch_size))
-                       for coord in covered_coords]
+    # change level from 0 to 1
+    extractor_groups = group_label_info_by_extractor(label_info, level_base)
 
-            data = construct_inference_dataloader_from_patches(patches, batch_size)
-
-            model: LightningModule = row.model
-            model.freeze()
-
-            heatmap = predict_on_single_ROI(model, data, ROI.size, extractor,
-                                            threshold=row.threshold,
-                                            output_coords=covered_coords)
-
-            mask = np.zeros_like(heatmap)
-            mask[heatmap != 0] = row.label
-
-            min_area = row.min_size // level_base
-
-            annotations[biopsy_id].extend(mask_to_annotation(mask,
-                                                             label_info,
-                                                             (maxx_level_0, maxy_level_0),
-                                                             mask_level=1,
-                                                             min_area=min_area,
-                                                             level_factor=level_base))
-            predicted_masks[biopsy_id].append(mask)
+    for biopsy_id, biopsy_contour in enumerate(tqdm(biopsy_contours)):
 
-            del patches, resized_ROI, data
+        bbox = get_biopsy_bbox(biopsy_contour)
+        upper_left_level_0 = bbox[0] * level_base, bbox[1] * level_base
+        ROI: Image = whole_slide_level_1.crop(biopsy_contour.bounds) if not streaming else None
+
+        biopsy_annotations = [[] for _ in range(len(label_info))]
+        biopsy_masks = [None for _ in range(len(label_info))]
+
+        for extractor, rows in extractor_groups:
+            covered_coords = get_biopsy_patches_coords(biopsy_contour, extractor)
+
+            if streaming:
+                covered_coords = group_patches_coords_by_tile(covered_coords, tile_size)
+                data = construct_inference_batches_from_slide(slide,
+                                                              covered_coords,
+                                                              upper_left_level_0,
+                                                              extractor.resize / level_base,
+                                                              extractor.patch_size,
+                                                              batch_size,
+                                                              tile_size=tile_size,
+                                                              recorder=recorder)
+            else:
+                resized_size = (int(ROI.size[0] * extractor.resize), int(ROI.size[1] * extractor.resize))
+                with recorder.stage("resize", pixels=resized_size[0] * resized_size[1]):
+                    resized_ROI = ROI.resize(resized_size)
+                with recorder.stage("patch_crop", patches=len(covered_coords)):
+                    patches = [resized_ROI.crop((coord[0],
+                                                 coord[1],
+                                                 coord[0] + extractor.patch_size,
+                                                 coord[1] + extractor.patch_size))
+                               for coord in covered_coords]
+
+                with recorder.stage("tensorize", patches=len(patches)):
+                    data = construct_inference_dataloader_from_patches(patches, batch_size)
+                del patches, resized_ROI
+
+            models: List[LightningModule] = [row.model for _, row in rows]
+            for model in models:
+                model.freeze()
+
+            outputs = predict_with_models(models, data, inference_config=inference_config, recorder=recorder)
+
+            for (layer_index, row), output in zip(rows, outputs):
+                mask, annotation = postprocess_biopsy_output(output, covered_coords, biopsy_contour,
+                                                             extractor, row, label_info, level_base,
+                                                             recorder=recorder,
+                                                             polygonize_workers=polygonize_workers,
+                                                             morphology_workers=morphology_workers,
+                                                             model_resolution=model_resolution_masks)
+                biopsy_annotations[layer_index] = annotation
+                biopsy_masks[layer_index] = mask
+
+            del data, outputs
+
+        annotations[biopsy_id] = list(chain.from_iterable(biopsy_annotations))
+        predicted_masks[biopsy_id] = biopsy_masks
 
     return predicted_masks, annotations
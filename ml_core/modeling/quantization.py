@@ -0,0 +1,148 @@
+import copy
+import re
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+"""
+========= Post-training Static Quantization ==========
+
+Models are quantized to int8 with FX graph mode (torch >= 1.13): conv + ReLU pairs are fused,
+activation ranges are calibrated on training patches, and the converted model is saved as TorchScript,
+so that inference only needs torch, without pytorch lightning or checkpoints.
+"""
+
+# torch.ao.quantization and FX graph mode quantization with example inputs
+MIN_TORCH_VERSION = (1, 13)
+
+
+def check_torch_version():
+    # requirements.txt accepts older versions of torch, which are enough for the rest of ml_core
+    version = tuple(int(v) for v in re.match(r"(\d+)\.(\d+)", torch.__version__).groups())
+    if version < MIN_TORCH_VERSION:
+        raise RuntimeError(f"int8 quantization needs torch >= {'.'.join(map(str, MIN_TORCH_VERSION))}, "
+                           f"but torch {torch.__version__} is installed.")
+
+
+def get_default_quantization_engine():
+    # "x86" supersedes "fbgemm" on recent versions of pytorch
+    supported_engines = torch.backends.quantized.supported_engines
+    return "x86" if "x86" in supported_engines else "fbgemm"
+
+
+def sample_dataloader(dataset, sample_size=None, batch_size=16, seed=0):
+    """
+    Dataloader over a random subset of a dataset, e.g., "Dataset" in ml_core.preprocessing.dataset;
+    use the whole dataset if sample_size is None
+    """
+    if sample_size is not None and sample_size < len(dataset):
+        indices = np.random.default_rng(seed).choice(len(dataset), sample_size, replace=False)
+        dataset = Subset(dataset, sorted(indices.tolist()))
+    return DataLoader(dataset, batch_size=batch_size, shuffle=False)
+
+
+def quantize_model(model, calibration_dataloader, engine=None):
+    """
+    Static int8 quantization of a float model
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        float model, e.g., UNet loaded from a checkpoint; left unchanged
+    calibration_dataloader : iterable
+        batches whose first item is an input batch, used to observe activation ranges
+    engine : str or None
+        quantized engine, e.g., "x86" or "fbgemm"; use the default engine of the platform if None
+
+    Returns
+    -------
+    quantized_model : torch.fx.GraphModule
+        int8 model taking and returning float tensors
+    """
+    check_torch_version()
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    engine = get_default_quantization_engine() if engine is None else engine
+    torch.backends.quantized.engine = engine
+
+    model = copy.deepcopy(model).cpu().eval()
+    example_input, *_ = next(iter(calibration_dataloader))
+
+    # fusion of conv + ReLU is part of prepare_fx;
+    # BatchNorm follows ReLU in UNetConvBlock, so it's quantized on its own
+    prepared_model = prepare_fx(model, get_default_qconfig_mapping(engine), example_inputs=(example_input,))
+    with torch.no_grad():
+        for img, *_ in calibration_dataloader:
+            prepared_model(img)
+
+    return convert_fx(prepared_model)
+
+
+def compute_f1_score(model, dataloader):
+    """
+    F1 score of the positive class over all pixels of a dataloader yielding (img, mask, ...)
+    """
+    true_positive, false_positive, false_negative = 0, 0, 0
+    with torch.no_grad():
+        for img, mask, *_ in dataloader:
+            device = getattr(model, "device", torch.device("cpu"))
+            prediction = torch.argmax(model(img.to(device)), dim=1).cpu() != 0
+            mask = mask != 0
+            true_positive += int((prediction & mask).sum())
+            false_positive += int((prediction & ~mask).sum())
+            false_negative += int((~prediction & mask).sum())
+
+    denominator = 2 * true_positive + false_positive + false_negative
+    return 2 * true_positive / denominator if denominator > 0 else 1.
+
+
+def save_quantized_model(quantized_model, path, example_input):
+    """
+    Save a quantized model as frozen TorchScript, together with its quantized engine
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with torch.no_grad():
+        scripted_model = torch.jit.freeze(torch.jit.trace(quantized_model, example_input))
+    torch.jit.save(scripted_model, str(path),
+                   _extra_files={"engine": torch.backends.quantized.engine.encode()})
+    return path
+
+
+class QuantizedModel:
+    """
+    Run a quantized TorchScript model behind the same interface as models used in inference,
+    i.e., it has a device, can be frozen, and maps a batch tensor to a logits tensor
+    """
+
+    def __init__(self, path):
+        check_torch_version()
+        extra_files = {"engine": ""}
+        self.path = Path(path)
+        self.module = torch.jit.load(str(path), map_location="cpu", _extra_files=extra_files)
+        self.engine = extra_files["engine"].decode() if isinstance(extra_files["engine"], bytes) \
+            else extra_files["engine"]
+        self.device = torch.device("cpu")
+
+    def freeze(self):
+        # TorchScript models are frozen when saved
+        pass
+
+    def eval(self):
+        return self
+
+    def to(self, *args, **kwargs):
+        # quantized kernels only run on CPU
+        return self
+
+    def __call__(self, img):
+        if self.engine and torch.backends.quantized.engine != self.engine:
+            torch.backends.quantized.engine = self.engine
+        return self.module(img.cpu())
+
+
+def load_quantized_model(path):
+    return QuantizedModel(path) if Path(path).exists() else None
@@ -0,0 +1,136 @@
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import torch
+
+"""
+========= Process-wide Cache of Loaded Models ==========
+"""
+
+
+def get_default_device():
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def estimate_model_size(model, model_path=None):
+    """
+    Bytes taken by a loaded model: parameters and buffers of torch modules,
+    or the size of the model file for other backends
+    """
+    if isinstance(model, torch.nn.Module):
+        tensors = list(model.parameters()) + list(model.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+    if model_path is not None and Path(model_path).exists():
+        return Path(model_path).stat().st_size
+    return 0
+
+
+class ModelRegistry:
+    """
+    Cache of loaded models keyed by (resolved model path, modification time, device),
+    evicting the least recently used models when their total size exceeds a memory budget
+    """
+
+    def __init__(self, memory_budget=4 * 1024 ** 3):
+        """
+        Parameters
+        ----------
+        memory_budget : int
+            bytes available to cached models; the most recently used model is always kept,
+            even if it exceeds the budget on its own
+        """
+        self.memory_budget = memory_budget
+        self._models = OrderedDict()
+        self._sizes = {}
+        # guards the cache itself, only held briefly; loading is serialized by a lock per key instead,
+        # so that loading a model never blocks lookups of other models
+        self._lock = threading.Lock()
+        self._loading_locks = {}
+
+    @staticmethod
+    def get_key(model_path, device=None):
+        model_path = Path(model_path).resolve()
+        device = get_default_device() if device is None else torch.device(device)
+        return str(model_path), model_path.stat().st_mtime_ns, str(device)
+
+    def get(self, model_path, loader, device=None):
+        """
+        Return the cached model of model_path, or load it with loader(model_path) and cache it
+
+        Parameters
+        ----------
+        model_path : str or Path
+            path to the model file
+        loader : Callable
+            function loading a model from its path, returning None if it can't be loaded
+        device : torch.device or str or None
+            device the loader puts the model on; the default device if None
+
+        Returns
+        -------
+        model : object or None
+            the loaded model, or None if model_path doesn't exist
+        """
+        if model_path is None or not Path(model_path).exists():
+            return None
+
+        key = self.get_key(model_path, device)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key]
+            loading_lock = self._loading_locks.setdefault(key, threading.Lock())
+
+        with loading_lock:
+            # another thread may have loaded the same model while waiting for loading_lock
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key]
+
+            model, size = None, 0
+            try:
+                model = loader(model_path)
+                if model is not None:
+                    size = estimate_model_size(model, model_path)
+            finally:
+                # insert and release the loading lock at once, so that no thread starts loading
+                # the same model again in between
+                with self._lock:
+                    if model is not None:
+                        # an updated file replaces the stale model of the same path
+                        for stale_key in [k for k in self._models if k[0] == key[0] and k[2] == key[2]]:
+                            self._remove(stale_key)
+
+                        self._models[key] = model
+                        self._sizes[key] = size
+                        self._evict()
+                    self._loading_locks.pop(key, None)
+            return model
+
+    @property
+    def total_size(self):
+        return sum(self._sizes.values())
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._sizes.clear()
+
+    def _remove(self, key):
+        del self._models[key]
+        del self._sizes[key]
+
+    def _evict(self):
+        while len(self._models) > 1 and self.total_size > self.memory_budget:
+            self._remove(next(iter(self._models)))
+
+    def __contains__(self, model_path):
+        return Path(model_path).exists() and self.get_key(model_path) in self._models
+
+    def __len__(self):
+        return len(self._models)
+
+
+default_model_registry = ModelRegistry()
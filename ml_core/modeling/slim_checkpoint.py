@@ -0,0 +1,148 @@
+import inspect
+import json
+import struct
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from .unet import UNet
+
+"""
+========= Inference-only Checkpoints ==========
+
+A slim checkpoint only keeps what inference needs: the architecture and the weights, without
+optimizer states or training hyper-parameters. The layout is
+    magic (8 bytes) | header length (8 bytes, little endian) | json header | padding | aligned raw tensors
+Tensors are memory-mapped copy-on-write when loaded, so worker processes loading the same file
+share its pages, and loading doesn't read the weights until they're used.
+"""
+
+SLIM_CHECKPOINT_MAGIC = b"AAPISLIM"
+SLIM_CHECKPOINT_ALIGNMENT = 64
+
+# classes that can be rebuilt from a slim checkpoint
+slim_model_classes = {
+    "UNet": UNet,
+}
+
+
+def _align(offset, alignment=SLIM_CHECKPOINT_ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def get_architecture(model):
+    """
+    Arguments of the model constructor, taken from its hyper-parameters,
+    excluding training arguments, e.g., optimizers
+    """
+    parameters = inspect.signature(type(model).__init__).parameters
+    names = [name for name, p in parameters.items()
+             if name != "self" and p.kind not in (p.VAR_KEYWORD, p.VAR_POSITIONAL)]
+    return {name: model.hparams[name] for name in names if name in model.hparams}
+
+
+def export_slim_checkpoint(model, path):
+    """
+    Save the architecture and the weights of a model in a slim checkpoint
+
+    Parameters
+    ----------
+    model : UNet
+        model whose class is in slim_model_classes, e.g., loaded from a lightning checkpoint
+    path : str or Path
+        path of the slim checkpoint
+
+    Returns
+    -------
+    path : Path
+        path of the slim checkpoint
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    arrays = {name: tensor.detach().cpu().contiguous().numpy() for name, tensor in model.state_dict().items()}
+
+    tensors, offset = {}, 0
+    for name, array in arrays.items():
+        offset = _align(offset)
+        tensors[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += array.nbytes
+
+    header = json.dumps({
+        "model_class": type(model).__name__,
+        "architecture": get_architecture(model),
+        "tensors": tensors,
+    }).encode()
+    data_start = _align(len(SLIM_CHECKPOINT_MAGIC) + 8 + len(header))
+
+    with open(path, "wb") as f:
+        f.write(SLIM_CHECKPOINT_MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + tensors[name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+
+    return path
+
+
+def read_slim_checkpoint_header(path):
+    with open(path, "rb") as f:
+        if f.read(len(SLIM_CHECKPOINT_MAGIC)) != SLIM_CHECKPOINT_MAGIC:
+            raise ValueError(f"{path} is not a slim checkpoint.")
+        header_length, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_length))
+    header["data_start"] = _align(len(SLIM_CHECKPOINT_MAGIC) + 8 + header_length)
+    return header
+
+
+def load_slim_checkpoint(path, device=None):
+    """
+    Build a model from a slim checkpoint, with weights memory-mapped from the file
+
+    Parameters
+    ----------
+    path : str or Path
+        path of the slim checkpoint
+    device : torch.device or None
+        if not None and not CPU, weights are copied to this device and no longer shared
+
+    Returns
+    -------
+    model : UNet
+        model in eval mode
+    """
+    header = read_slim_checkpoint_header(path)
+    model = slim_model_classes[header["model_class"]](**header["architecture"])
+
+    # copy-on-write, so that tensors are writable but pages are shared until written
+    buffer = np.memmap(path, dtype=np.uint8, mode="c")
+    state_dict = {}
+    for name, info in header["tensors"].items():
+        dtype = np.dtype(info["dtype"])
+        start = header["data_start"] + info["offset"]
+        count = int(np.prod(info["shape"]))
+        array = buffer[start:start + count * dtype.itemsize].view(dtype).reshape(info["shape"])
+        state_dict[name] = torch.from_numpy(array)
+
+    # point parameters and buffers to the mapped tensors instead of copying them
+    for module_name, module in model.named_modules():
+        prefix = f"{module_name}." if module_name else ""
+        for name, parameter in module.named_parameters(recurse=False):
+            module._parameters[name] = torch.nn.Parameter(state_dict[prefix + name],
+                                                          requires_grad=parameter.requires_grad)
+        for name in list(module._buffers):
+            if module._buffers[name] is not None:
+                module._buffers[name] = state_dict[prefix + name]
+
+    if device is not None:
+        model.to(device)
+    return model.eval()
+
+
+def load_model_from_slim_checkpoint(path):
+    if not Path(path).exists():
+        return None
+    return load_slim_checkpoint(path, device=torch.device("cuda") if torch.cuda.is_available() else None)
@@ -76,17 +76,13 @@ class UNet(pl.LightningModule):
 
         self.train_kwargs = train_kwargs
 
+        # optimizers and schedulers are only built in configure_optimizers,
+        # so that models loaded for inference never construct them;
+        # every scheduler is a callable taking an optimizer, one per optimizer or one shared by all
         self.optimizer = self.train_kwargs.get("optimizer",
                                                [partial(Adam, lr=1e-3)])
-        self.optimizer = [opt(self.parameters()) for opt in self.optimizer]
-
         self.scheduler = self.train_kwargs.get("scheduler",
-                                               [ReduceLROnPlateau(opt, factor=0.1, patience=25)
-                                                for opt in self.optimizer])
-        self.scheduler = [{
-            'scheduler': lr_scheduler,
-            'reduce_on_plateau': True,
-            'monitor': 'val/loss'} for lr_scheduler in self.scheduler]
+                                               [partial(ReduceLROnPlateau, factor=0.1, patience=25)])
         self.criterion = self.train_kwargs.get("criterion", nn.CrossEntropyLoss(reduction="none"))
         self.edge_weight = self.train_kwargs.get("edge_weight", 1.)
 
@@ -104,7 +100,14 @@ class UNet(pl.LightningModule):
         return self.last(x)
 
     def configure_optimizers(self):
-        return self.optimizer, self.scheduler
+        optimizers = [opt(self.parameters()) for opt in self.optimizer]
+        schedulers = self.scheduler if len(self.scheduler) == len(optimizers) \
+            else self.scheduler * len(optimizers)
+        schedulers = [{
+            'scheduler': scheduler(opt),
+            'reduce_on_plateau': True,
+            'monitor': 'val/loss'} for scheduler, opt in zip(schedulers, optimizers)]
+        return optimizers, schedulers
 
     def __shared_step_op(self, batch, batch_idx, phase, log=True):
         img, mask, edge_mask = batch
@@ -197,7 +200,8 @@ class UNetUpBlock(nn.Module):
         self.conv_block = UNetConvBlock(in_size, out_size, padding, batch_norm)
 
     def center_crop(self, layer, target_size):
-        _, _, layer_height, layer_width = layer.size()
+        # index the shape instead of unpacking it, so that the block can be traced by torch.fx
+        layer_height, layer_width = layer.shape[2], layer.shape[3]
         diff_y = (layer_height - target_size[0]) // 2
         diff_x = (layer_width - target_size[1]) // 2
         return layer[:, :, diff_y:(diff_y + target_size[0]), diff_x:(diff_x + target_size[1])]
@@ -0,0 +1,161 @@
+import configparser
+import threading
+import time
+import traceback
+from pathlib import Path
+
+import torch
+
+from .postprocessing import load_label_info_from_config, get_latest_model_of_section, model_backends, \
+    predict_with_model
+from ..preprocessing.patches_extraction import Extractor
+
+"""
+========= Hot Reload of Checkpoints in Long-running Processes ==========
+
+A background thread polls the model directory of every class in the config file;
+new models are loaded and warmed up in the background, then swapped into the live label info at once.
+Requests keep the label info they started with, so they are never blocked or affected by a swap.
+"""
+
+
+def warm_up_model(model, patch_size, in_channels=3, batch_size=1):
+    """
+    Run a dummy batch through the inference path, so that lazy initializations,
+    e.g., CUDA contexts or kernel selections, don't slow down the first request
+    """
+    dummy_input = torch.zeros((batch_size, in_channels, patch_size, patch_size))
+    predict_with_model(model, [(dummy_input,)])
+
+
+class CheckpointWatcher:
+    """
+    Live label info whose models are replaced when newer models are dropped into their directories
+    """
+
+    def __init__(self, config_file, interval=60., settle_time=5., model_registry=None, verbose=True):
+        """
+        Parameters
+        ----------
+        config_file : str or Path
+            the config .ini file, e.g., ml_core/label_info.ini
+        interval : float
+            seconds between two polls of the model directories
+        settle_time : float
+            seconds a new model file must stay unmodified before it's loaded,
+            so that files being copied or written are not loaded halfway
+        model_registry : ml_core.modeling.registry.ModelRegistry or None
+            if not None, models are loaded through this cache
+        verbose : bool
+            if True, print a message for every swapped or failed model
+        """
+        self.config_file = Path(config_file)
+        self.interval = interval
+        self.settle_time = settle_time
+        self.model_registry = model_registry
+        self.verbose = verbose
+
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+        # every class of the config file is watched, including those without any model yet,
+        # which are left out of the live label info until a model of theirs is loaded
+        self._label_info = load_label_info_from_config(self.config_file, model_registry=model_registry,
+                                                       drop_missing_models=False)
+        self._model_versions = {row.label_name: self._get_version(row.model_path)
+                                for row in self._label_info.itertuples() if row.model is not None}
+
+    @staticmethod
+    def _get_version(model_path):
+        model_path = Path(model_path)
+        return str(model_path.resolve()), model_path.stat().st_mtime_ns
+
+    @property
+    def label_info(self):
+        """
+        Snapshot of the live label info, i.e., classes with a loaded model; later swaps don't change it
+        """
+        with self._lock:
+            label_info = self._label_info
+        # a new frame sharing the models, so that columns added by a request stay local to it
+        return label_info[label_info["model"].notna()].copy(deep=False)
+
+    def poll(self):
+        """
+        Check the model directory of every class once, and swap in newer models
+
+        Returns
+        -------
+        swapped : List[str]
+            label names whose models have been swapped
+        """
+        config = configparser.ConfigParser()
+        config.read(self.config_file)
+
+        swapped = []
+        for row in self._label_info.itertuples():
+            if row.label_name not in config:
+                continue
+
+            backend, model_path = get_latest_model_of_section(self.config_file, config[row.label_name])
+            if model_path is None:
+                continue
+
+            try:
+                version = self._get_version(model_path)
+                if version == self._model_versions.get(row.label_name) \
+                        or time.time() - version[1] / 1e9 < self.settle_time:
+                    continue
+
+                model = self._load_model(backend, model_path)
+                warm_up_model(model, Extractor(config_section_name=row.extractor_config_name).patch_size)
+            except Exception:
+                # e.g., a corrupted file; try again at the next poll
+                if self.verbose:
+                    print(f"[Warning] Failed to load {model_path} for {row.label_name}:\n{traceback.format_exc()}")
+                continue
+
+            self._swap(row.label_name, model, model_path, backend)
+            self._model_versions[row.label_name] = version
+            swapped.append(row.label_name)
+            if self.verbose:
+                print(f"Swapped in {model_path} for {row.label_name}.")
+
+        return swapped
+
+    def _load_model(self, backend, model_path):
+        loader = model_backends[backend][1]
+        model = loader(model_path) if self.model_registry is None else self.model_registry.get(model_path, loader)
+        if model is None:
+            raise FileNotFoundError(f"{model_path} doesn't exist.")
+        model.freeze()
+        return model
+
+    def _swap(self, label_name, model, model_path, backend):
+        # build the new label info aside and replace the reference at once;
+        # a deep copy of the frame still shares the models of other classes
+        label_info = self._label_info.copy()
+        index = label_info.index[label_info["label_name"] == label_name][0]
+        label_info.at[index, "model"] = model
+        label_info.at[index, "model_path"] = str(model_path)
+        label_info.at[index, "backend"] = backend
+        with self._lock:
+            self._label_info = label_info
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.poll()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -112,6 +112,56 @@ class Extractor:
 
         return img_patches
 
+    def extract_tiles(self, img: Image, tile_size: int, halo: int, interp_method=Image.BICUBIC):
+        """
+        Interface for extracting large overlapping tiles from an image after resizing,
+        used by fully convolutional inference instead of sliding patches.
+        Adjacent tiles overlap by 2 * halo pixels, so that the interiors of all tiles,
+        i.e., tiles without the halo on each side, cover the resized image without overlapping.
+
+        Parameters
+        ----------
+        img : PIL Image
+            image to extract tiles from
+        tile_size : int
+            height and width of a tile, including the halo on both sides
+        halo : int
+            size of the border of every tile which only serves as context
+        interp_method : callable, PIL.Image.BICUBIC by default
+            interpolation method for resizing, see "extract_patches"
+
+        Returns
+        -------
+        img_tiles: np.array with shape (ntile, tile_size, tile_size, 3)
+            extracted tiles from input image
+        interior_coords: np.array with shape (ntile, 2)
+            (x, y) coordinates of the upper left corner of every tile interior
+            in the resized image
+        """
+        step = tile_size - 2 * halo
+        assert step > 0, f"Tile size {tile_size} is too small for a halo of {halo} pixels."
+
+        resized_shape = tuple(map(lambda x: int(x*self.resize), img.size))
+        img = img.resize(size=resized_shape, resample=interp_method)
+        width, height = resized_shape
+        row_count, col_count = int(np.ceil(height / step)), int(np.ceil(width / step))
+
+        # mirror padding with the halo on every side,
+        # plus the extra space needed by the last row and column of tiles
+        img = np.pad(img,
+                     pad_width=[(halo, row_count * step - height + halo),
+                                (halo, col_count * step - width + halo),
+                                (0, 0)],
+                     mode="reflect")
+
+        img_tiles: np.ndarray = extract_patches(img, (tile_size, tile_size, 3), step)
+        img_tiles = img_tiles.reshape((-1, tile_size, tile_size, 3))  # type: ndarray
+
+        tile_rows, tile_cols = np.unravel_index(range(row_count * col_count), (row_count, col_count))
+        interior_coords = np.column_stack([tile_cols, tile_rows]) * step
+
+        return img_tiles, interior_coords
+
 
 def extract_img_patches(img: Union[Path, str, np.ndarray],
                         extractor: Extractor):
@@ -154,9 +204,8 @@ def extract_img_patches(img: Union[Path, str, np.ndarray],
     # TODO: determine a more robust way of tissue detection;
     # currently, keep all patches whose mean(R_channel) <= 220
 
-    keep_indices = filter(lambda patch_id: np.mean(img_patches[patch_id, ..., 0]) <= 220,
-                          range(len(img_patches)))
-    keep_indices = list(keep_indices)
+    tissue_scores = np.mean(img_patches[..., 0], axis=(1, 2))
+    keep_indices = np.flatnonzero(tissue_scores <= 220).tolist()
 
     return img_patches, keep_indices
 
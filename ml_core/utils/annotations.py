@@ -10,6 +10,9 @@ from PIL import ImageColor
 from collections import defaultdict
 from typing import List
 from itertools import chain
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from .tracing import traced
 
 
 class ASAPAnnotation:
@@ -213,6 +216,7 @@ def load_annotations_from_halo_xml(xml_path):
     return asap_annotations
 
 
+@traced
 def create_asap_annotation_file(annotations, filename):
     """
     Dump list of annotations to file
@@ -306,6 +310,7 @@ def annotation_to_mask(annotations,
     return img_mask
 
 
+@traced
 def mask_to_polygon(binary_mask, min_area):
     contours, hierarchy = cv2.findContours(cv2.convertScaleAbs(binary_mask),
                                                   cv2.RETR_EXTERNAL,
@@ -325,12 +330,261 @@ def mask_to_polygon(binary_mask, min_area):
     return all_polygons
 
 
+def _contour_area_bound(stats):
+    # a contour through the pixels of a w x h bounding box can't enclose more than (w - 1) * (h - 1)
+    return (stats[:, cv2.CC_STAT_WIDTH] - 1) * (stats[:, cv2.CC_STAT_HEIGHT] - 1)
+
+
+def _find_holes(component):
+    # pixels enclosed by a component, i.e., background not 4-connected to the outside,
+    # which is how cv2.findContours decides that a contour isn't external
+    outside = np.pad(component, 1)
+    cv2.floodFill(outside, None, (0, 0), 1)
+    return outside[1:-1, 1:-1] == 0
+
+
+def _enclosing_boxes(boxes, chunk_size=1024):
+    # for every box (x, y, w, h) strictly inside others, the indices of those others;
+    # pairs are compared in chunks to bound the memory of the comparison matrix
+    x0, y0 = boxes[:, 0], boxes[:, 1]
+    x1, y1 = x0 + boxes[:, 2], y0 + boxes[:, 3]
+    enclosing = defaultdict(list)
+    for start in range(0, len(boxes), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        inner, outer = np.nonzero((x0 < x0[chunk, np.newaxis]) & (y0 < y0[chunk, np.newaxis]) &
+                                  (x1 > x1[chunk, np.newaxis]) & (y1 > y1[chunk, np.newaxis]))
+        for i, j in zip(inner + start, outer):
+            enclosing[i].append(j)
+    return enclosing
+
+
+def _find_objects(mask, top, bottom, min_areas, cut_above=False, cut_below=False):
+    # objects of every label in rows [top, bottom) of a mask, as (start pixel (y, x), bounding box (x, y, w, h),
+    # binary crop of the object) in mask coordinates; objects touching a cut edge of the strip may continue
+    # in the next strip, so they are kept whatever their sizes, and flagged as the last item;
+    # also returns the labels left to _trace_label_contours
+    strip = mask[top:bottom]
+    strip_height = bottom - top
+    # BBDT is the fastest of the labeling algorithms of OpenCV on large sparse masks
+    _, regions, region_stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(strip, 8, cv2.CV_32S,
+                                                                                cv2.CCL_GRANA)
+
+    def touches_cut(y, h):
+        return (cut_above & (y == 0)) | (cut_below & (y + h == strip_height))
+
+    # connected regions of the foreground may contain several labels, so split them into objects of one label
+    objects = {label: [] for label in min_areas}
+    mixed_regions = []
+    smallest_area = min(min_areas.values()) if min_areas else 0
+    kept = (_contour_area_bound(region_stats) >= smallest_area) | \
+        touches_cut(region_stats[:, cv2.CC_STAT_TOP], region_stats[:, cv2.CC_STAT_HEIGHT])
+    for region_id in np.flatnonzero(kept):
+        if region_id == 0:
+            continue
+        x, y, w, h = region_stats[region_id, :4]
+        region = (regions[y:y + h, x:x + w] == region_id).view(np.uint8)
+        region_mask = strip[y:y + h, x:x + w]
+
+        lowest, highest, _, _ = cv2.minMaxLoc(region_mask, mask=region)
+        if lowest == highest:
+            # most regions are a single object
+            label = int(lowest)
+            is_cut = bool(touches_cut(y, h))
+            if label in min_areas and ((w - 1) * (h - 1) >= min_areas[label] or is_cut):
+                start = (top + y, x + int(np.argmax(region[0])))
+                objects[label].append((start, (x, top + y, w, h), region, is_cut))
+            continue
+
+        region_labels = np.flatnonzero(cv2.calcHist([region_mask], [0], region, [256], [0, 256]).ravel())
+        mixed_regions.append(((x, y, w, h), region, region_mask, [label for label in region_labels
+                                                                  if label in min_areas]))
+
+    # labels spread over large mixed regions, e.g., classes touching each other all over the mask,
+    # are cheaper to trace on the whole mask than to label again region by region
+    mixed_areas = defaultdict(int)
+    for (_, _, w, h), _, _, region_labels in mixed_regions:
+        for label in region_labels:
+            mixed_areas[label] += w * h
+    dense_labels = {label for label, area in mixed_areas.items() if area * 4 >= strip.size}
+
+    for (x, y, w, h), region, region_mask, region_labels in mixed_regions:
+        for label in region_labels:
+            if label in dense_labels or ((w - 1) * (h - 1) < min_areas[label] and not touches_cut(y, h)):
+                continue
+            _, components, stats, _ = cv2.connectedComponentsWithStatsWithAlgorithm(
+                region & (region_mask == label), 8, cv2.CV_32S, cv2.CCL_GRANA)
+
+            component_cut = touches_cut(y + stats[:, cv2.CC_STAT_TOP], stats[:, cv2.CC_STAT_HEIGHT])
+            for component_id in np.flatnonzero((_contour_area_bound(stats) >= min_areas[label]) | component_cut):
+                if component_id == 0:
+                    continue
+                cx, cy, cw, ch = stats[component_id, :4]
+                component = np.array(components[cy:cy + ch, cx:cx + cw] == component_id, dtype=np.uint8)
+                start = (top + y + cy, x + cx + int(np.argmax(component[0])))
+                objects[label].append((start, (x + cx, top + y + cy, cw, ch), component,
+                                       bool(component_cut[component_id])))
+    return objects, dense_labels
+
+
+def _merge_cut_objects(objects, cuts, width):
+    # join the pieces of objects of one label split by the cuts between strips, i.e., pieces whose
+    # pixels on both sides of a cut are 8-connected, into the same objects as found without cuts
+    parents = list(range(len(objects)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for cut in cuts:
+        # ids of the pieces owning every pixel of the rows right above and right below the cut
+        above, below = np.full(width + 2, -1), np.full(width + 2, -1)
+        for i, (_, (x, y, w, h), component) in enumerate(objects):
+            if y + h == cut:
+                above[1 + x + np.flatnonzero(component[-1])] = i
+            elif y == cut:
+                below[1 + x + np.flatnonzero(component[0])] = i
+        for shift in (-1, 0, 1):
+            neighbors = np.roll(below, shift)
+            connected = (above >= 0) & (neighbors >= 0)
+            for i, j in zip(above[connected], neighbors[connected]):
+                parents[find(i)] = find(j)
+
+    groups = defaultdict(list)
+    for i in range(len(objects)):
+        groups[find(i)].append(objects[i])
+
+    merged = []
+    for pieces in groups.values():
+        if len(pieces) == 1:
+            merged.append(pieces[0])
+            continue
+        boxes = np.array([box for _, box, _ in pieces])
+        x, y = boxes[:, :2].min(axis=0)
+        w, h = (boxes[:, :2] + boxes[:, 2:]).max(axis=0) - (x, y)
+        component = np.zeros((h, w), dtype=np.uint8)
+        for _, (px, py, pw, ph), piece in pieces:
+            component[py - y:py - y + ph, px - x:px - x + pw] |= piece
+        merged.append((min(start for start, _, _ in pieces), (x, y, w, h), component))
+    return merged
+
+
+def _trace_label_contours(mask, label, min_area):
+    # the same as mask_to_polygon, on the whole mask
+    contours = cv2.findContours(np.array(mask == label, dtype=np.uint8), cv2.RETR_EXTERNAL,
+                                cv2.CHAIN_APPROX_TC89_L1)[0]
+    return [contour[:, 0, :] for contour in contours if cv2.contourArea(contour) >= min_area]
+
+
+def _trace_external_contours(objects, min_area):
+    # cv2.findContours lists contours in the reverse raster order of their start pixels
+    objects = sorted(objects, key=lambda o: o[0], reverse=True)
+    boxes = np.array([box for _, box, _ in objects], dtype=np.int64).reshape((-1, 4))
+    enclosing = _enclosing_boxes(boxes)
+    holes = {}
+
+    contours = []
+    for object_id, ((start_y, start_x), (x, y, w, h), component) in enumerate(objects):
+        # objects inside holes of others aren't external, whatever their sizes
+        is_enclosed = False
+        for other in enclosing.get(object_id, ()):
+            ox, oy = boxes[other, :2]
+            if other not in holes:
+                holes[other] = _find_holes(objects[other][2])
+            if holes[other][start_y - oy, start_x - ox]:
+                is_enclosed = True
+                break
+        if is_enclosed:
+            continue
+
+        contour, = cv2.findContours(component, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_TC89_L1)[0]
+        if cv2.contourArea(contour) >= min_area:
+            contours.append(contour[:, 0, :] + (x, y))
+    return contours
+
+
+@traced
+def mask_to_polygons_by_label(mask, min_areas, workers=1, min_strip_height=256, max_strip_pixels=2 ** 20):
+    """
+    External contours of every label in a multi-class mask, the same as mask_to_polygon
+    on the binary mask of every label, in the same order, but scaling with the number of objects:
+    one connected components pass finds the objects of all labels, strip by strip to bound the memory
+    of the label image, objects cut by the strip edges are joined back, objects whose bounding box
+    can't hold min_area are dropped from their stats, and contours are only traced within
+    the bounding boxes of the remaining objects; labels mostly touching other labels, which the
+    connected components of the foreground don't separate, are traced on the whole mask instead
+
+    With several workers, strips are labeled by a thread pool, and contours of every label are traced
+    by the pool as well; OpenCV releases the GIL, and the contours are the same as with one worker
+
+    Parameters
+    ----------
+    mask : 2D np.array
+        multi-class mask, 0 being the background
+    min_areas : dict
+        minimal contour area of every label to polygonize
+    workers : int
+        number of threads
+    min_strip_height : int
+        masks are split into one strip per worker, of at least this many rows
+    max_strip_pixels : int
+        strips are small enough to have about this many pixels, unless they'd be thinner than min_strip_height
+
+    Returns
+    -------
+    contours : dict
+        for every label in min_areas, a list of contours with shape (n, 2) in (x, y) mask coordinates
+    """
+    # labels are uint8 in masks, as in annotation_to_mask
+    mask = np.asarray(mask, dtype=np.uint8)
+    height, width = mask.shape
+    # int32 labels take 4 bytes per pixel against 1 for the mask, so only strips of the mask are labeled at once
+    rows_per_strip = max(min_strip_height, max_strip_pixels // max(width, 1))
+    n_strips = max(1, min(workers, height // min_strip_height), -(-height // rows_per_strip))
+    cuts = [height * i // n_strips for i in range(1, n_strips)]
+    bounds = list(zip([0] + cuts, cuts + [height]))
+
+    def find_objects(strip_bounds):
+        top, bottom = strip_bounds
+        return _find_objects(mask, top, bottom, min_areas, cut_above=top > 0, cut_below=bottom < height)
+
+    def trace(label):
+        if label in dense_labels:
+            return _trace_label_contours(mask, label, min_areas[label])
+        return _trace_external_contours(objects[label], min_areas[label])
+
+    with ThreadPoolExecutor(workers) if workers > 1 else contextlib.nullcontext() as pool:
+        strips = list(pool.map(find_objects, bounds) if pool is not None else map(find_objects, bounds))
+
+        dense_labels = set().union(*(labels for _, labels in strips))
+        strips = [objects for objects, _ in strips]
+
+        objects = {}
+        for label, min_area in min_areas.items():
+            if label in dense_labels:
+                continue
+            label_objects = [o for strip in strips for o in strip[label]]
+            whole = [o[:3] for o in label_objects if not o[3]]
+            merged = _merge_cut_objects([o[:3] for o in label_objects if o[3]], cuts, width)
+            # pieces were kept whatever their sizes, so filter the joined objects as whole ones
+            objects[label] = whole + [o for o in merged if (o[1][2] - 1) * (o[1][3] - 1) >= min_area]
+        del strips
+
+        labels = list(min_areas)
+        contours = pool.map(trace, labels) if pool is not None else map(trace, labels)
+        return dict(zip(labels, contours))
+
+
+@traced
 def mask_to_annotation(mask,
                        label_info,
                        upper_left_coordinates,
                        mask_level,
                        level_factor=4,
-                       min_area=100):
+                       min_area=100,
+                       workers=1,
+                       mask_downsample=1):
     """
     Convert a mask (uint8 array-like) to list of annotations,
     in order to render on ASAP frontend.
@@ -359,6 +613,13 @@ def mask_to_annotation(mask,
     min_area : int
         polygons with area smaller than min_area will be ignored for generating annotations;
         if "min_area" is not provided in label_info, the default value here will be used
+    workers : int
+        number of threads polygonizing strips of the mask and classes concurrently;
+        annotations are the same whatever the number of threads
+    mask_downsample : float or tuple(float, float)
+        downsampling factor (x, y) of the mask relative to mask_level, e.g., for a mask left at model resolution;
+        pixel centers of the mask are mapped to pixel centers of mask_level, and min_area, given on mask_level,
+        is scaled down accordingly
 
     Returns
     -------
@@ -373,26 +634,33 @@ def mask_to_annotation(mask,
     mask = np.array(mask)
     mask_2d = mask[..., 0] if len(mask.shape) == 3 else mask
     
-    for label_row in label_info.itertuples():
-
-        if label_row.label_name == "Background":
-            # skip the background
+    # skip the background
+    label_rows = [row for row in label_info.itertuples() if row.label_name != "Background"]
+    min_areas = {row.label: row.min_area if hasattr(row, "min_area") else min_area for row in label_rows}
+    downsample_x, downsample_y = np.broadcast_to(mask_downsample, 2)
+    if downsample_x != 1 or downsample_y != 1:
+        min_areas = {label: area / (downsample_x * downsample_y) for label, area in min_areas.items()}
+    contours = mask_to_polygons_by_label(mask_2d, min_areas, workers=workers)
+
+    for label_row in label_rows:
+        label_contours = contours[label_row.label]
+        if not label_contours:
             continue
 
-        binary_mask = np.array(mask_2d == label_row.label, dtype=np.uint8)
-        polygons = mask_to_polygon(binary_mask,
-                                   min_area=label_row.min_area if hasattr(label_row, "min_area") else min_area)
-        if polygons is not None:
-            # apply reverse transformation to original coordinates
-            transform_matrix = [upsample_rate, 0, 0, upsample_rate, upper_left_x, upper_left_y]
-            polygons = map(lambda p: affine_transform(p, transform_matrix), polygons)
-
-            label_name = label_row.label_name
-            annotations += [ASAPAnnotation(geometry=p,
-                                           annotation_name=f"{label_name}_{i}",
-                                           group_name=label_name,
-                                           render_color=label_row.color)
-                            for i, p in enumerate(polygons)]
+        # apply reverse transformation to original coordinates, to all vertices of the label at once
+        vertices = np.concatenate(label_contours).astype(np.float64)
+        if downsample_x != 1 or downsample_y != 1:
+            vertices = (vertices + 0.5) * (downsample_x, downsample_y) - 0.5
+        vertices = vertices * upsample_rate + (upper_left_x, upper_left_y)
+        split_indices = np.cumsum([len(c) for c in label_contours])[:-1]
+        polygons = [Polygon(shell=v) for v in np.split(vertices, split_indices)]
+
+        label_name = label_row.label_name
+        annotations += [ASAPAnnotation(geometry=p,
+                                       annotation_name=f"{label_name}_{i}",
+                                       group_name=label_name,
+                                       render_color=label_row.color)
+                        for i, p in enumerate(polygons)]
     return annotations
 
 
@@ -433,6 +701,7 @@ def generate_colorful_mask(mask, label_info):
     return colorful_mask
 
 
+@traced
 def merge_annotations(annotations_group: List[List[ASAPAnnotation]]):
     group_name_index = defaultdict(list)
 
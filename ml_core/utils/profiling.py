@@ -0,0 +1,331 @@
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+"""
+========= Per-stage Instrumentation of Inference ==========
+
+Stages of the inference pipeline, e.g., "slide_read", "forward" or "polygonize", emit a start and a stop
+event with counts of what they processed (patches, pixels, polygons, ...) to pluggable sinks.
+A sink is any callable taking a StageEvent; SummarySink and JSONReportSink aggregate them,
+and MemorySink records the peak memory of every stage.
+"""
+
+STAGES = ("slide_read", "thumbnail", "biopsy_detection", "resize", "patch_crop", "tensorize",
+          "forward", "stitch", "morphology", "aggregate", "polygonize", "xml_serialize")
+
+
+class StageEvent:
+    def __init__(self, stage, phase, timestamp, duration=None, counts=None):
+        self.stage = stage
+        self.phase = phase
+        self.timestamp = timestamp
+        self.duration = duration
+        self.counts = {} if counts is None else counts
+        self.thread = threading.current_thread().name
+
+    def to_dict(self):
+        return {
+            "stage": self.stage,
+            "phase": self.phase,
+            "timestamp": self.timestamp,
+            "duration": self.duration,
+            "counts": self.counts,
+            "thread": self.thread,
+        }
+
+
+class StageRecorder:
+    """
+    Emit start and stop events of stages to sinks; does nothing if there's no sink
+    """
+
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.sinks)
+
+    def emit(self, event):
+        # stages may run in several threads, e.g., in the pipelined inference
+        with self._lock:
+            for sink in self.sinks:
+                sink(event)
+
+    @contextmanager
+    def stage(self, name, **counts):
+        """
+        Time a stage; counts known at the end can be added to the yielded dict
+
+        Examples
+        --------
+        >>> with recorder.stage("polygonize", pixels=mask.size) as counts:
+        ...     annotations = mask_to_annotation(...)
+        ...     counts["polygons"] = len(annotations)
+        """
+        if not self.sinks:
+            yield counts
+            return
+
+        start = time.perf_counter()
+        self.emit(StageEvent(name, "start", start, counts=dict(counts)))
+        try:
+            yield counts
+        finally:
+            stop = time.perf_counter()
+            self.emit(StageEvent(name, "stop", stop, duration=stop - start, counts=counts))
+
+
+# shared by all calls without instrumentation
+null_recorder = StageRecorder()
+
+
+def get_stage_recorder(callback=None):
+    """
+    Turn the callback argument of inference functions into a recorder
+
+    Parameters
+    ----------
+    callback : StageRecorder or callable or List[callable] or None
+        a recorder, one sink or a list of sinks; no instrumentation if None
+    """
+    if callback is None:
+        return null_recorder
+    if isinstance(callback, StageRecorder):
+        return callback
+    return StageRecorder(callback if isinstance(callback, (list, tuple)) else [callback])
+
+
+class SummarySink:
+    """
+    Aggregate the number of calls, total time and counts of every stage
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    def __call__(self, event):
+        if event.phase != "stop":
+            return
+        summary = self.stages.setdefault(event.stage, {"calls": 0, "seconds": 0., "counts": {}})
+        summary["calls"] += 1
+        summary["seconds"] += event.duration
+        for key, value in event.counts.items():
+            summary["counts"][key] = summary["counts"].get(key, 0) + value
+
+    def summary(self):
+        return {stage: {"calls": s["calls"], "seconds": s["seconds"], **s["counts"]}
+                for stage, s in self.stages.items()}
+
+    def table(self):
+        """
+        Summary as a text table, in the order of STAGES
+        """
+        stages = sorted(self.stages, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES))
+        total = sum(s["seconds"] for s in self.stages.values())
+        lines = [f"{'stage':<18}{'calls':>8}{'seconds':>10}{'share':>8}  counts"]
+        for stage in stages:
+            s = self.stages[stage]
+            share = s["seconds"] / total if total > 0 else 0.
+            counts = ", ".join(f"{k}={v}" for k, v in s["counts"].items())
+            lines.append(f"{stage:<18}{s['calls']:>8}{s['seconds']:>10.3f}{share:>8.1%}  {counts}")
+        return "\n".join(lines)
+
+
+class JSONReportSink(SummarySink):
+    """
+    Keep every event, and write them with the summary to a json file
+    """
+
+    def __init__(self, path=None):
+        super().__init__()
+        self.path = path
+        self.events = []
+
+    def __call__(self, event):
+        super().__call__(event)
+        self.events.append(event.to_dict())
+
+    def report(self):
+        return {"summary": self.summary(), "events": self.events}
+
+    def write(self, path=None):
+        path = Path(self.path if path is None else path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        return path
+
+
+def get_rss():
+    """
+    Resident set size of this process in bytes, or None if unknown
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+
+def get_peak_rss():
+    """
+    Highest resident set size of this process so far in bytes, or None if unknown
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MemorySink:
+    """
+    Record the peak memory of every stage, e.g.,
+
+    >>> with MemorySink() as sink:
+    ...     segment_WSI(slide_path, callback=sink)
+    >>> print(sink.table())
+
+    For every stage, the highest value over its calls of
+        traced_peak: peak of memory allocated by python and numpy during the stage,
+            above what was allocated when the stage started, measured by tracemalloc
+        rss_growth: growth of the peak resident set size of the process during the stage,
+            i.e., how much the stage raised the high-water mark, including memory of torch and openslide
+        rss: resident set size at the end of the stage
+    Peaks are process-wide, so stages running concurrently in other threads contribute to them.
+    """
+
+    def __init__(self, trace_allocations=True):
+        """
+        Parameters
+        ----------
+        trace_allocations : bool
+            if True, trace python allocations with tracemalloc while the sink is started,
+            which slows down python code; RSS is recorded in any case
+        """
+        self.trace_allocations = trace_allocations
+        self.stages = OrderedDict()
+        self.peak_rss = None
+        self.traced_peak = 0
+        self._open_stages = []
+        self._started_tracemalloc = False
+
+    def start(self):
+        if self.trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        return self
+
+    def stop(self):
+        self.peak_rss = get_peak_rss()
+        if tracemalloc.is_tracing():
+            self.traced_peak = max(self.traced_peak, tracemalloc.get_traced_memory()[1])
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+                self._started_tracemalloc = False
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _update_traced_peaks(self):
+        # fold the peak since the previous event into every open stage, then measure anew,
+        # so that nested and concurrent stages all see the peaks of their whole duration
+        if not tracemalloc.is_tracing():
+            return None
+        current, peak = tracemalloc.get_traced_memory()
+        self.traced_peak = max(self.traced_peak, peak)
+        for open_stage in self._open_stages:
+            open_stage["traced_peak"] = max(open_stage["traced_peak"], peak)
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        return current
+
+    def __call__(self, event):
+        traced_current = self._update_traced_peaks()
+
+        if event.phase == "start":
+            self._open_stages.append({"stage": event.stage,
+                                      "thread": event.thread,
+                                      "traced_start": traced_current,
+                                      "traced_peak": traced_current or 0,
+                                      "peak_rss_start": get_peak_rss()})
+            return
+
+        open_stage = next((s for s in reversed(self._open_stages)
+                           if s["stage"] == event.stage and s["thread"] == event.thread), None)
+        if open_stage is None:
+            return
+        self._open_stages.remove(open_stage)
+
+        memory = self.stages.setdefault(event.stage, {"calls": 0, "traced_peak": None,
+                                                      "rss_growth": None, "rss": None})
+        memory["calls"] += 1
+        if open_stage["traced_start"] is not None:
+            memory["traced_peak"] = max(memory["traced_peak"] or 0,
+                                        open_stage["traced_peak"] - open_stage["traced_start"])
+        peak_rss = get_peak_rss()
+        if peak_rss is not None and open_stage["peak_rss_start"] is not None:
+            memory["rss_growth"] = max(memory["rss_growth"] or 0, peak_rss - open_stage["peak_rss_start"])
+        rss = get_rss()
+        if rss is not None:
+            memory["rss"] = max(memory["rss"] or 0, rss)
+
+    def summary(self):
+        """
+        Peaks of every stage in bytes, and the peaks of the whole run under "total"
+        """
+        summary = {stage: dict(memory) for stage, memory in self.stages.items()}
+        summary["total"] = {"traced_peak": self.traced_peak if self.trace_allocations else None,
+                            "peak_rss": self.peak_rss if self.peak_rss is not None else get_peak_rss()}
+        return summary
+
+    def table(self):
+        """
+        Summary as a text table in MB, in the order of STAGES
+        """
+        def to_mb(value):
+            return "-" if value is None else f"{value / 1024 ** 2:.1f}"
+
+        stages = sorted(self.stages, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES))
+        lines = [f"{'stage':<18}{'calls':>8}{'traced MB':>12}{'RSS growth MB':>16}{'RSS MB':>10}"]
+        for stage in stages:
+            m = self.stages[stage]
+            lines.append(f"{stage:<18}{m['calls']:>8}{to_mb(m['traced_peak']):>12}"
+                         f"{to_mb(m['rss_growth']):>16}{to_mb(m['rss']):>10}")
+        total = self.summary()["total"]
+        lines.append(f"{'total':<18}{'':>8}{to_mb(total['traced_peak']):>12}{'':>16}{to_mb(total['peak_rss']):>10}")
+        return "\n".join(lines)
+
+
+def record_stage_iteration(recorder, name, iterable, count_key="patches"):
+    """
+    Yield items of an iterable, recording the time to produce every item as a stage,
+    e.g., tiles read lazily from a slide
+    """
+    iterator = iter(iterable)
+    while True:
+        with recorder.stage(name) as counts:
+            item = next(iterator, None)
+            counts[count_key] = 0 if item is None else len(item)
+        if item is None:
+            return
+        yield item
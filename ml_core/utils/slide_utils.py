@@ -13,23 +13,32 @@ from shapely.geometry import Polygon, box
 
 from .annotations import create_covering_rectangles_using_clusters, create_covering_rectangles_greedy
 from .annotations import annotation_to_mask, mask_to_polygon, generate_colorful_mask
+from .tracing import traced
 
 
 LEVEL_BASE = 4
 HIGHEST_LEVEL = 2
 
 
+@traced
 def read_slide(path):
     return open_slide(str(path)) if path is not None and Path(path).exists() else None
 
 
+def get_slide_paths(data_dir, suffixes=(".tif",)):
+    data_dir = Path(data_dir)
+    slide_paths = [p for suffix in suffixes for p in data_dir.glob(f"**/*{suffix}")]
+    return sorted(filter(lambda x: "mask" not in str(x), slide_paths))
+
+
 def get_slide_and_mask_paths(data_dir):
     data_dir = Path(data_dir)
-    slide_paths = sorted(filter(lambda x: "mask" not in str(x), data_dir.glob("**/*.tif")))
+    slide_paths = get_slide_paths(data_dir)
     mask_paths = [data_dir / str(p.name).replace(".tif", "_mask.tif") for p in slide_paths]
     return slide_paths, mask_paths
 
 
+@traced
 def read_region_from_slide(slide, x, y, level, width, height,
                            relative_coordinate=True):
     if relative_coordinate:
@@ -46,6 +55,240 @@ def read_region_from_slide(slide, x, y, level, width, height,
     return im
 
 
+def get_best_level_for_resize(slide, resize, tolerance=1e-3):
+    # the lowest resolution level which still has at least
+    # the resolution required by the resize factor (based on level 0)
+    target_downsample = (1 / resize) * (1 + tolerance)
+    best_level = 0
+    for level, downsample in enumerate(slide.level_downsamples):
+        if downsample <= target_downsample:
+            best_level = level
+    return best_level
+
+
+# fixed-point precision of Pillow's resampling of 8-bit images
+PIL_PRECISION_BITS = 32 - 8 - 2
+
+
+def _bicubic_filter(x, a=-0.5):
+    # the bicubic kernel of Pillow
+    x = abs(x)
+    if x < 1.0:
+        return ((a + 2.0) * x - (a + 3.0)) * x * x + 1
+    if x < 2.0:
+        return (((x - 5) * x + 8) * x - 4) * a
+    return 0.0
+
+
+def get_bicubic_resize_coefficients(in_size, out_size):
+    """
+    Input ranges and fixed-point weights of every output pixel when Pillow resizes
+    in_size pixels to out_size pixels along one axis with Image.BICUBIC,
+    replicating its arithmetic so that the results are bit-exact
+
+    Returns
+    -------
+    bounds : List[tuple(int, int)]
+        range [start, stop) of input pixels of every output pixel
+    coefficients : List[np.array]
+        integer weights of the input pixels of every output pixel, scaled by 2 ** PIL_PRECISION_BITS
+    """
+    scale = filter_scale = in_size / out_size
+    filter_scale = max(filter_scale, 1.0)
+    support = 2.0 * filter_scale
+    inverse_scale = 1.0 / filter_scale
+
+    bounds, coefficients = [], []
+    for i in range(out_size):
+        center = (i + 0.5) * scale
+        start = max(int(center - support + 0.5), 0)
+        stop = min(int(center + support + 0.5), in_size)
+        weights = [_bicubic_filter((j - center + 0.5) * inverse_scale) for j in range(start, stop)]
+        # summed in order, as floating point additions aren't associative
+        total = 0.0
+        for w in weights:
+            total += w
+        if total != 0.0:
+            weights = [w / total for w in weights]
+        weights = [int(w * (1 << PIL_PRECISION_BITS) + (0.5 if w >= 0 else -0.5)) for w in weights]
+        bounds.append((start, stop))
+        coefficients.append(np.array(weights, dtype=np.float64))
+    return bounds, coefficients
+
+
+@traced
+def read_level_thumbnail(slide, level, level_base=LEVEL_BASE, tile_size=2048):
+    """
+    Thumbnail of a level downsampled by exactly level_base, i.e., of size (width // level_base, height // level_base),
+    equal to resizing the full level with PIL.Image.resize, but read in full-width strips of about
+    tile_size ** 2 pixels, so that the level is never loaded as a whole
+
+    Every strip is resized horizontally by Pillow, which doesn't depend on other rows;
+    the vertical pass replicates Pillow's bicubic resampling over a sliding window of resized rows,
+    since resizing strips vertically on their own would shift Pillow's coefficients and change pixels
+    """
+    width, height = slide.level_dimensions[level]
+    thumbnail_width, thumbnail_height = width // level_base, height // level_base
+    strip_height = max(1, tile_size ** 2 // width)
+
+    thumbnail = np.empty((thumbnail_height, thumbnail_width, 3), dtype=np.uint8)
+    # horizontally resized rows [rows_start, rows_start + len(rows)) of the level
+    rows, rows_start = np.empty((0, thumbnail_width, 3), dtype=np.uint8), 0
+    for y, ((start, stop), weights) in enumerate(zip(*get_bicubic_resize_coefficients(height, thumbnail_height))):
+        while rows_start + len(rows) < stop:
+            strip_y = rows_start + len(rows)
+            strip_rows = min(strip_height, height - strip_y)
+            strip = read_region_from_slide(slide, 0, strip_y, level, width, strip_rows)
+            strip = strip.resize((thumbnail_width, strip_rows), box=(0, 0, width, strip_rows))
+            # drop rows which no later thumbnail row uses
+            rows = np.concatenate([rows[start - rows_start:], np.asarray(strip)])
+            rows_start = start
+
+        # weights times 8-bit pixels fit in the mantissa of float64, so the sums are exact integers
+        window = rows[start - rows_start:stop - rows_start].reshape(stop - start, -1)
+        pixels = (weights @ window).astype(np.int64) + (1 << (PIL_PRECISION_BITS - 1))
+        thumbnail[y] = np.clip(pixels >> PIL_PRECISION_BITS, 0, 255).reshape(thumbnail_width, 3)
+
+    return Image.fromarray(thumbnail)
+
+
+@traced
+def group_patches_coords_by_tile(coords, tile_size):
+    """
+    Reorder patch coordinates so that patches whose upper left corners
+    fall into the same (tile_size x tile_size) tile are adjacent
+
+    Parameters
+    ----------
+    coords : array-like with shape (n, 2)
+        (x, y) coordinates of patches
+    tile_size : int
+        side length of a tile, using the same reference frame as coords
+
+    Returns
+    -------
+    sorted_coords : np.array with shape (n, 2)
+        coordinates reordered tile by tile (row-major)
+    """
+    coords = np.array(coords, dtype=np.int64).reshape(-1, 2)
+    tile_ids = np.floor_divide(coords, tile_size)
+    order = np.lexsort((coords[:, 0], coords[:, 1], tile_ids[:, 0], tile_ids[:, 1]))
+    return coords[order]
+
+
+def split_patches_coords_by_tile(coords, tile_size):
+    """
+    Split patch coordinates into runs of consecutive coordinates
+    whose upper left corners fall into the same tile
+
+    Parameters
+    ----------
+    coords : array-like with shape (n, 2)
+        (x, y) coordinates of patches, usually sorted by "group_patches_coords_by_tile"
+    tile_size : int
+        side length of a tile, using the same reference frame as coords
+
+    Returns
+    -------
+    tiles_coords : List[np.array]
+        coordinates of every tile, in the same order as coords
+    """
+    coords = np.array(coords, dtype=np.int64).reshape(-1, 2)
+    if len(coords) == 0:
+        return []
+
+    tile_ids = np.floor_divide(coords, tile_size)
+    boundaries = np.flatnonzero(np.any(np.diff(tile_ids, axis=0) != 0, axis=1)) + 1
+    return np.split(coords, boundaries)
+
+
+@traced
+def read_patches_of_tile(slide, tile_coords, patch_size, upper_left, resize, level):
+    """
+    Read the smallest region of a slide covering all given patches, and crop patches from it
+
+    Parameters
+    ----------
+    slide : openslide.OpenSlide
+        slide to read patches from
+    tile_coords : np.array with shape (n, 2)
+        (x, y) coordinates of patches in the resized frame,
+        relative to the upper left corner of the region
+    patch_size : int
+        height and width of a patch
+    upper_left : tuple(float, float)
+        upper left corner of the region, defined in level-0 coordinate system
+    resize : float
+        resize factor from level 0 to the resized frame
+    level : int
+        level to read from
+
+    Returns
+    -------
+    patches : np.array with shape (n, patch_size, patch_size, 3)
+        uint8 patches, in the same order as tile_coords
+    """
+    # scale from the level to read from to the resized frame
+    level_scale = resize * slide.level_downsamples[level]
+
+    min_x, min_y = tile_coords.min(axis=0)
+    max_x, max_y = tile_coords.max(axis=0) + patch_size
+    tile_width, tile_height = int(max_x - min_x), int(max_y - min_y)
+
+    tile = read_region_from_slide(slide,
+                                  x=int(round(upper_left[0] + min_x / resize)),
+                                  y=int(round(upper_left[1] + min_y / resize)),
+                                  level=level,
+                                  width=int(np.ceil(tile_width / level_scale)),
+                                  height=int(np.ceil(tile_height / level_scale)),
+                                  relative_coordinate=False)
+    if tile.size != (tile_width, tile_height):
+        tile = tile.resize((tile_width, tile_height), resample=Image.BICUBIC)
+    tile = np.asarray(tile)
+
+    offsets = tile_coords - [min_x, min_y]
+    return np.stack([tile[y:y + patch_size, x:x + patch_size] for x, y in offsets])
+
+
+def read_patches_from_slide(slide, coords, patch_size, upper_left, resize, tile_size=2048, level=None):
+    """
+    Read patches of a region tile by tile, so that only one tile of the slide
+    is held in memory at a time instead of the whole region
+
+    Parameters
+    ----------
+    slide : openslide.OpenSlide
+        slide to read patches from
+    coords : array-like with shape (n, 2)
+        (x, y) coordinates of patches in the resized frame,
+        relative to the upper left corner of the region;
+        patches are yielded in the same order, so use "group_patches_coords_by_tile"
+        beforehand to make every tile read only once
+    patch_size : int
+        height and width of a patch
+    upper_left : tuple(float, float)
+        upper left corner of the region, defined in level-0 coordinate system
+    resize : float
+        resize factor from level 0 to the resized frame
+    tile_size : int
+        side length of a tile in the resized frame; a tile together with the overhang
+        of its patches is the largest region read from the slide at once
+    level : int or None
+        level to read from; use the best level for the resize factor if None
+
+    Yields
+    ------
+    patches : np.array with shape (n_tile, patch_size, patch_size, 3)
+        uint8 patches for the coordinates falling into one tile
+    """
+    if level is None:
+        level = get_best_level_for_resize(slide, resize)
+
+    for tile_coords in split_patches_coords_by_tile(coords, tile_size):
+        yield read_patches_of_tile(slide, tile_coords, patch_size, upper_left, resize, level)
+
+
+@traced
 def read_full_slide_by_level(slide_path, level):
     slide = open_slide(str(slide_path))
     return read_region_from_slide(slide, x=0, y=0, level=level,
@@ -128,6 +371,7 @@ def crop_ROI_from_slide(slide_path, save_dir, size, stride, level,
                 slide_patch.save(save_dir / patch_name)
 
 
+@traced
 def generate_patches_coords(width, height, patch_size, stride, pad_size):
     def get_edge_count(length):
         return (2 * pad_size + length - patch_size) // stride + 1
@@ -142,6 +386,7 @@ def generate_patches_coords(width, height, patch_size, stride, pad_size):
     return output_coords
 
 
+@traced
 def get_biopsy_contours(image):
     # detect biopsy regions: Otsu's thresholding after Gaussian filtering
     blur = cv2.GaussianBlur(np.array(image), (25, 25), 0)
@@ -152,6 +397,7 @@ def get_biopsy_contours(image):
     return region_polygons
 
 
+@traced
 def get_biopsy_covered_patches_coords(biopsy_contour, width, height, patch_size, stride, pad_size):
     # get patches coords
     all_patch_coords = generate_patches_coords(width, height, patch_size, stride, pad_size)
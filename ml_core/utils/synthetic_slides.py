@@ -0,0 +1,263 @@
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+from shapely.geometry import Point
+from shapely.affinity import scale, rotate, translate
+
+from .annotations import ASAPAnnotation, create_asap_annotation_file
+
+"""
+========= Synthetic Slides for Benchmarks and Tests ==========
+
+Procedurally generated tissue, i.e., elliptic biopsies containing elliptic objects of some classes,
+rendered region by region, so that pyramidal tiled TIFF slides of up to 100k pixels on a side
+are written tile by tile without holding any level in memory.
+The slides are readable by openslide, and the objects can be written as an ASAP annotation file.
+"""
+
+BACKGROUND_COLOR = (235, 235, 235)
+TISSUE_COLOR = (222, 164, 196)
+
+# group name, range of radii on level 0, rendered color, annotation color
+DEFAULT_OBJECT_CLASSES = (
+    ("Glomerulus", (250, 450), (150, 80, 160), "#4dd156"),
+    ("Tubules", (60, 120), (196, 112, 160), "#e89f17"),
+)
+
+
+class SyntheticTissue:
+    def __init__(self,
+                 width,
+                 height,
+                 n_biopsies=4,
+                 objects_per_biopsy=8,
+                 object_classes=DEFAULT_OBJECT_CLASSES,
+                 noise=12,
+                 seed=0):
+        """
+        Layout of biopsies and objects on level 0 of a slide
+
+        Parameters
+        ----------
+        width : int
+            width of level 0
+        height : int
+            height of level 0
+        n_biopsies : int
+            number of elongated elliptic biopsies
+        objects_per_biopsy : int
+            number of objects of every class placed inside every biopsy
+        object_classes : Tuple
+            (group name, (min radius, max radius), RGB color, annotation color) of every class of objects
+        noise : int
+            amplitude of the per-pixel noise of tissue colors
+        seed : int
+            seed of the layout and of the noise
+        """
+        self.width = width
+        self.height = height
+        self.object_classes = object_classes
+        self.noise = noise
+        self.seed = seed
+
+        rng = np.random.default_rng(seed)
+
+        # (center x, center y, semi-major axis, semi-minor axis, angle, lobe phase)
+        self.biopsies = []
+        for biopsy_id in range(n_biopsies):
+            # spread biopsies along the long side of the slide
+            cell = width / n_biopsies
+            cx = cell * (biopsy_id + rng.uniform(0.35, 0.65))
+            cy = height * rng.uniform(0.35, 0.65)
+            a = min(height * rng.uniform(0.3, 0.45), cell * 0.9)
+            b = min(a * rng.uniform(0.35, 0.5), cell * 0.4)
+            self.biopsies.append((cx, cy, a, b, rng.uniform(np.pi / 3, 2 * np.pi / 3), rng.uniform(0, 2 * np.pi)))
+
+        # (class id, center x, center y, semi-major axis, semi-minor axis, angle)
+        self.objects = []
+        for cx, cy, a, b, angle, _ in self.biopsies:
+            for class_id, (_, (min_radius, max_radius), _, _) in enumerate(object_classes):
+                for _ in range(objects_per_biopsy):
+                    radius = rng.uniform(min_radius, max_radius)
+                    # uniformly inside the inner part of the biopsy, without overlapping other objects;
+                    # the object is dropped if there's no room left
+                    for _ in range(20):
+                        r, theta = np.sqrt(rng.uniform(0, 0.6)), rng.uniform(0, 2 * np.pi)
+                        u, v = r * a * np.cos(theta), r * b * np.sin(theta)
+                        ox, oy = cx + u * np.cos(angle) - v * np.sin(angle), cy + u * np.sin(angle) + v * np.cos(angle)
+                        if all((ox - o[1]) ** 2 + (oy - o[2]) ** 2 > (radius + o[3]) ** 2 for o in self.objects):
+                            self.objects.append((class_id, ox, oy, radius, radius * rng.uniform(0.7, 1.),
+                                                 rng.uniform(0, np.pi)))
+                            break
+
+    @staticmethod
+    def _inside_ellipse(xs, ys, cx, cy, a, b, angle, lobe_phase=None):
+        dx, dy = xs - cx, ys - cy
+        u = dx * np.cos(angle) + dy * np.sin(angle)
+        v = -dx * np.sin(angle) + dy * np.cos(angle)
+        distance = (u / a) ** 2 + (v / b) ** 2
+        if lobe_phase is None:
+            return distance <= 1
+        # irregular outline of biopsies
+        radius = 1 + 0.1 * np.sin(3 * np.arctan2(v / b, u / a) + lobe_phase)
+        return distance <= radius ** 2
+
+    def render(self, x, y, width, height, downsample=1):
+        """
+        Render a region of the slide
+
+        Parameters
+        ----------
+        x, y : int
+            upper left corner of the region, in the coordinates of the rendered level
+        width, height : int
+            size of the region on the rendered level
+        downsample : float
+            downsampling factor of the rendered level relative to level 0
+
+        Returns
+        -------
+        region : np.array
+            uint8 RGB array of shape (height, width, 3)
+        """
+        region = np.empty((height, width, 3), dtype=np.uint8)
+        region[...] = BACKGROUND_COLOR
+
+        # level 0 bounds of the region, and pixel centers
+        min_x, min_y = x * downsample, y * downsample
+        max_x, max_y = (x + width) * downsample, (y + height) * downsample
+
+        def overlaps(cx, cy, radius):
+            return cx + radius >= min_x and cx - radius <= max_x and cy + radius >= min_y and cy - radius <= max_y
+
+        biopsies = [b for b in self.biopsies if overlaps(b[0], b[1], b[2] * 1.1)]
+        if not biopsies:
+            return region
+
+        xs = ((x + np.arange(width) + 0.5) * downsample)[np.newaxis, :]
+        ys = ((y + np.arange(height) + 0.5) * downsample)[:, np.newaxis]
+
+        tissue = np.zeros((height, width), dtype=bool)
+        for cx, cy, a, b, angle, lobe_phase in biopsies:
+            tissue |= self._inside_ellipse(xs, ys, cx, cy, a, b, angle, lobe_phase)
+        if not tissue.any():
+            return region
+
+        colors = np.zeros((height, width, 3), dtype=np.int16)
+        colors[...] = TISSUE_COLOR
+        for class_id, cx, cy, a, b, angle in self.objects:
+            if overlaps(cx, cy, a):
+                colors[self._inside_ellipse(xs, ys, cx, cy, a, b, angle)] = self.object_classes[class_id][2]
+
+        # noise depends on the region, so that rendering is reproducible region by region
+        rng = np.random.default_rng((self.seed, int(x), int(y), int(round(downsample * 1000))))
+        colors += rng.integers(-self.noise, self.noise + 1, size=colors.shape, dtype=np.int16)
+        region[tissue] = np.clip(colors[tissue], 0, 255).astype(np.uint8)
+        return region
+
+    def annotations(self):
+        """
+        Objects as polygons in level 0 coordinates
+
+        Returns
+        -------
+        annotations : List[ASAPAnnotation]
+            one annotation per object, grouped by class
+        """
+        annotations = []
+        for object_id, (class_id, cx, cy, a, b, angle) in enumerate(self.objects):
+            group_name, _, _, annotation_color = self.object_classes[class_id]
+            ellipse = translate(rotate(scale(Point(0, 0).buffer(1, 16), a, b), angle, use_radians=True), cx, cy)
+            annotations.append(ASAPAnnotation(ellipse, f"Annotation {object_id}", group_name, annotation_color))
+        return annotations
+
+
+def generate_synthetic_ROI(width, height, seed=0, **tissue_kwargs):
+    """
+    Synthetic ROI filled by one biopsy, e.g., as the input of segment_ROI
+
+    Returns
+    -------
+    ROI : PIL.Image
+        RGB image of size (width, height)
+    tissue : SyntheticTissue
+        layout of the ROI, whose annotations are the objects in the ROI
+    """
+    tissue = SyntheticTissue(width, height, n_biopsies=1, seed=seed, **tissue_kwargs)
+    return Image.fromarray(tissue.render(0, 0, width, height)), tissue
+
+
+def write_synthetic_slide(path,
+                          width,
+                          height,
+                          n_levels=3,
+                          level_base=4,
+                          tile_size=256,
+                          compression="zlib",
+                          annotation_path=None,
+                          seed=0,
+                          **tissue_kwargs):
+    """
+    Write a pyramidal tiled TIFF readable by openslide, tile by tile
+
+    Parameters
+    ----------
+    path : str or Path
+        path of the .tif file
+    width, height : int
+        size of level 0
+    n_levels : int
+        number of levels, every one downsampled by level_base from the previous one;
+        levels smaller than a tile are not written
+    level_base : int
+        downsampling factor between every two adjacent levels
+    tile_size : int
+        side length of TIFF tiles, a multiple of 16
+    compression : str or None
+        TIFF compression of tiles, e.g., "zlib", or "jpeg" if imagecodecs is installed
+    annotation_path : str or Path or None
+        if not None, the objects are also written to this ASAP annotation file
+    seed : int
+        seed of the layout
+    tissue_kwargs :
+        other arguments of SyntheticTissue, e.g., n_biopsies or objects_per_biopsy
+
+    Returns
+    -------
+    tissue : SyntheticTissue
+        layout of the slide
+    """
+    import tifffile
+
+    tissue = SyntheticTissue(width, height, seed=seed, **tissue_kwargs)
+
+    def iterate_tiles(level_width, level_height, downsample):
+        for tile_y in range(0, level_height, tile_size):
+            for tile_x in range(0, level_width, tile_size):
+                # edge tiles are rendered whole, and cropped by readers
+                yield tissue.render(tile_x, tile_y, tile_size, tile_size, downsample)
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # classic TIFF offsets overflow beyond 4 GB
+    bigtiff = width * height * 3 > 2 ** 32 - 2 ** 28
+
+    with tifffile.TiffWriter(str(path), bigtiff=bigtiff) as tif:
+        for level in range(n_levels):
+            downsample = level_base ** level
+            level_width, level_height = width // downsample, height // downsample
+            if level > 0 and min(level_width, level_height) < tile_size:
+                break
+            tif.write(iterate_tiles(level_width, level_height, downsample),
+                      shape=(level_height, level_width, 3),
+                      dtype=np.uint8,
+                      tile=(tile_size, tile_size),
+                      photometric="rgb",
+                      compression=compression,
+                      subfiletype=1 if level > 0 else 0)
+
+    if annotation_path is not None:
+        create_asap_annotation_file(tissue.annotations(), annotation_path)
+
+    return tissue
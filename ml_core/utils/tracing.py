@@ -0,0 +1,167 @@
+import functools
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+"""
+========= Chrome Trace Events of Inference Functions ==========
+
+Functions decorated with "traced" record a span per call once tracing is started,
+written in the trace event format viewable in chrome://tracing or https://ui.perfetto.dev.
+Spans are laid out by process and thread, and nest by time within a thread.
+Shapes and lengths of arguments, e.g., batch sizes, are kept as span args.
+When tracing is not started, a decorated call costs a single global lookup.
+"""
+
+_tracer = None
+
+
+class Tracer:
+    def __init__(self, path):
+        self.path = Path(str(path).format(pid=os.getpid()))
+        self.pid = os.getpid()
+        self.events = []
+        self._thread_names = {}
+        self._lock = threading.Lock()
+        # wall clock at start, so that traces of several processes line up when merged
+        self._origin = time.time() - time.perf_counter()
+
+    def now(self):
+        # microseconds
+        return (self._origin + time.perf_counter()) * 1e6
+
+    def add_span(self, name, category, start, duration, args):
+        thread = threading.current_thread()
+        with self._lock:
+            if thread.ident not in self._thread_names:
+                self._thread_names[thread.ident] = thread.name
+            self.events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start,
+                "dur": duration,
+                "pid": self.pid,
+                "tid": thread.ident,
+                "args": args,
+            })
+
+    def to_json(self):
+        with self._lock:
+            metadata = [{"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": f"pid {self.pid}"}}]
+            metadata.extend({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                            for tid, name in self._thread_names.items())
+            return {"traceEvents": metadata + list(self.events), "displayTimeUnit": "ms"}
+
+    def write(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump(self.to_json(), f)
+        return self.path
+
+
+def _describe(value):
+    shape = getattr(value, "shape", None)
+    if shape is not None:
+        return list(shape)
+    if isinstance(value, (bool, int, float, str)) and not (isinstance(value, str) and len(value) > 256):
+        return value
+    if isinstance(value, (list, tuple, dict)):
+        return f"len={len(value)}"
+    if hasattr(value, "size") and isinstance(value.size, tuple):
+        # PIL images
+        return list(value.size)
+    return None
+
+
+def _describe_arguments(args, kwargs):
+    described = {f"arg{i}": _describe(value) for i, value in enumerate(args)}
+    described.update({key: _describe(value) for key, value in kwargs.items()})
+    return {key: value for key, value in described.items() if value is not None}
+
+
+def traced(func):
+    """
+    Record a span for every call of func while tracing is started
+    """
+    name = func.__qualname__
+    category = func.__module__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        tracer = _tracer
+        if tracer is None:
+            return func(*args, **kwargs)
+
+        start = tracer.now()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            tracer.add_span(name, category, start, tracer.now() - start, _describe_arguments(args, kwargs))
+
+    return wrapper
+
+
+def start_tracing(path="trace_{pid}.json"):
+    """
+    Start recording spans of traced functions in this process
+
+    Parameters
+    ----------
+    path : str or Path
+        trace file written by stop_tracing; "{pid}" is replaced by the process id,
+        so that worker processes can write their own traces
+    """
+    global _tracer
+    _tracer = Tracer(path)
+    return _tracer
+
+
+def stop_tracing():
+    """
+    Stop recording and write the trace file
+
+    Returns
+    -------
+    path : Path or None
+        path to the trace file, or None if tracing was not started
+    """
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return None if tracer is None else tracer.write()
+
+
+class tracing:
+    """
+    Trace the enclosed block, e.g.,
+
+    >>> with tracing("slide.trace.json"):
+    ...     segment_WSI(slide_path)
+    """
+
+    def __init__(self, path="trace_{pid}.json"):
+        self.path = path
+
+    def __enter__(self):
+        return start_tracing(self.path)
+
+    def __exit__(self, *exc_info):
+        stop_tracing()
+
+
+def merge_traces(trace_paths, output_path):
+    """
+    Merge trace files of several processes into one file, with one lane per process
+    """
+    events = []
+    for trace_path in trace_paths:
+        with open(trace_path) as f:
+            events.extend(json.load(f)["traceEvents"])
+
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    return output_path
@@ -0,0 +1,227 @@
+import sys
+sys.path.append("../")
+
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from benchmark_memory import create_random_label_info
+from ml_core.utils.synthetic_slides import generate_synthetic_ROI, write_synthetic_slide
+
+
+BENCHMARKS = ("extract_patches", "construct_dataloader", "predict_with_model", "generate_heatmap",
+              "enhance_heatmap", "enhance_heatmap_by_tiles", "mask_to_annotation", "create_asap_annotation_file",
+              "segment_ROI", "segment_WSI")
+
+
+def time_function(function, repeats):
+    """
+    Fastest of several runs in seconds, which is the least affected by other processes, and the last result
+    """
+    timings, result = [], None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def run_benchmarks(args):
+    """
+    Time every benchmark on synthetic inputs
+
+    Returns
+    -------
+    results : dict
+        seconds and throughputs of every benchmark, e.g., {"seconds": 0.5, "patches/s": 1000.}
+    """
+    import torch
+    from ml_core.api import segment_ROI, segment_WSI
+    from ml_core.modeling.postprocessing import construct_inference_dataloader_from_patches, \
+        predict_with_model, generate_heatmap, enhance_heatmap, enhance_heatmap_by_tiles
+    from ml_core.preprocessing.patches_extraction import Extractor
+    from ml_core.utils.annotations import annotation_to_mask, mask_to_annotation, create_asap_annotation_file
+
+    torch.set_num_threads(args.num_threads)
+    label_info = create_random_label_info()
+    extractor = Extractor(config_section_name=f"AAPI_{label_info.label_name[0]}")
+    model = label_info.model[0]
+
+    ROI, tissue = generate_synthetic_ROI(args.roi_size, args.roi_size, seed=1)
+    megapixels = args.roi_size ** 2 / 1e6
+    annotations = tissue.annotations()
+
+    def record(name, seconds, **units):
+        results[name] = {"seconds": seconds, **{f"{unit}/s": count / seconds for unit, count in units.items()}}
+        throughputs = ", ".join(f"{count / seconds:.1f} {unit}/s" for unit, count in units.items())
+        print(f"{name:<30}{seconds:>10.3f} s  {throughputs}")
+
+    results = {}
+    benchmarks = set(args.benchmarks)
+
+    seconds, patches = time_function(lambda: extractor.extract_patches(ROI), args.repeats)
+    if "extract_patches" in benchmarks:
+        record("extract_patches", seconds, patches=len(patches), megapixels=megapixels)
+
+    def construct_and_load():
+        # the dataloader is lazy, so batches are drained as inference would
+        dataloader = construct_inference_dataloader_from_patches(patches, args.batch_size)
+        return dataloader, sum(len(batch) for batch, in dataloader)
+
+    seconds, (dataloader, n_patches) = time_function(construct_and_load, args.repeats)
+    if "construct_dataloader" in benchmarks:
+        record("construct_dataloader", seconds, patches=n_patches)
+
+    if "predict_with_model" in benchmarks:
+        model.freeze()
+        seconds, _ = time_function(lambda: predict_with_model(model, dataloader), args.repeats)
+        record("predict_with_model", seconds, patches=n_patches)
+
+    # random outputs, so that the postprocessing doesn't depend on the model
+    outputs = np.random.default_rng(0).random((len(patches), extractor.patch_size, extractor.patch_size),
+                                              dtype=np.float32)
+    seconds, heatmap = time_function(lambda: generate_heatmap(ROI.size, outputs, extractor), args.repeats)
+    if "generate_heatmap" in benchmarks:
+        record("generate_heatmap", seconds, patches=len(outputs), megapixels=megapixels)
+
+    if "enhance_heatmap" in benchmarks:
+        seconds, _ = time_function(lambda: enhance_heatmap(heatmap), args.repeats)
+        record("enhance_heatmap", seconds, megapixels=megapixels)
+
+    if "enhance_heatmap_by_tiles" in benchmarks:
+        heatmap_array = np.array(heatmap)
+        seconds, _ = time_function(lambda: enhance_heatmap_by_tiles(heatmap_array), args.repeats)
+        record("enhance_heatmap_by_tiles", seconds, megapixels=megapixels)
+
+    if "mask_to_annotation" in benchmarks:
+        mask = annotation_to_mask(annotations, label_info, (0, 0), (args.roi_size, args.roi_size), level=0)
+        seconds, polygons = time_function(lambda: mask_to_annotation(mask, label_info, (0, 0), mask_level=0),
+                                          args.repeats)
+        record("mask_to_annotation", seconds, megapixels=megapixels, polygons=len(polygons))
+
+    if "create_asap_annotation_file" in benchmarks:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            xml_path = Path(tmp_dir) / "annotations.xml"
+            seconds, _ = time_function(lambda: create_asap_annotation_file(annotations, xml_path), args.repeats)
+        record("create_asap_annotation_file", seconds, annotations=len(annotations))
+
+    if "segment_ROI" in benchmarks:
+        seconds, _ = time_function(lambda: segment_ROI([ROI], [(0, 0)], label_info=label_info.copy(),
+                                                       batch_size=args.batch_size), args.repeats)
+        record("segment_ROI", seconds, megapixels=megapixels)
+
+    if "segment_WSI" in benchmarks:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            slide_path = Path(tmp_dir) / "synthetic_slide.tif"
+            write_synthetic_slide(slide_path, args.slide_size, args.slide_size * 3 // 4)
+            seconds, _ = time_function(lambda: segment_WSI(slide_path, label_info=label_info.copy(),
+                                                           batch_size=args.batch_size,
+                                                           streaming=args.streaming), args.wsi_repeats)
+        # megapixels of level 0, as slide sizes are usually quoted
+        record("segment_WSI", seconds, megapixels=args.slide_size * (args.slide_size * 3 // 4) / 1e6)
+
+    return results
+
+
+def compare_with_baseline(results, baselines, tolerance):
+    """
+    Print throughputs next to the baseline, and return False if any of them dropped beyond the tolerance
+    """
+    passed = True
+    for name, result in results.items():
+        for key, value in result.items():
+            if not key.endswith("/s"):
+                continue
+            baseline = baselines.get(name, {}).get(key)
+            regressed = baseline is not None and value < baseline * (1 - tolerance)
+            passed = passed and not regressed
+            baseline_text = "-" if baseline is None else f"{baseline:.1f}"
+            change = "" if baseline is None else f" ({value / baseline - 1:+.0%})"
+            print(f"{name:<30}{key:<16}{value:>12.1f} (baseline: {baseline_text:>10}){change:<8} "
+                  f"... {'REGRESSED' if regressed else 'ok'}")
+    return passed
+
+
+def benchmark_inference(args):
+    baselines = json.loads(args.baseline_path.read_text()) if args.baseline_path.exists() else {}
+    settings = {"roi_size": args.roi_size, "slide_size": args.slide_size, "batch_size": args.batch_size,
+                "streaming": args.streaming, "num_threads": args.num_threads}
+    if baselines and baselines.get("settings") != settings:
+        print(f"[Warning] Baseline was measured with {baselines.get('settings')}, not {settings}.")
+
+    results = run_benchmarks(args)
+
+    if args.update_baseline:
+        baselines.update(results)
+        baselines["settings"] = settings
+        args.baseline_path.write_text(json.dumps(baselines, indent=2))
+        print(f"Baseline written to {args.baseline_path}.")
+        return True
+
+    print()
+    return compare_with_baseline(results, baselines, args.tolerance)
+
+
+def parse_arguments(input_args=None):
+    parser = argparse.ArgumentParser(description="Measure the throughput of inference functions on synthetic "
+                                                 "inputs and randomly initialized models, against a stored baseline.")
+
+    parser.add_argument("--baseline_path",
+                        default="inference_baseline.json",
+                        help="json file of the baseline throughputs; regenerate it with --update_baseline "
+                             "when moving to another machine or after an intended change.")
+    parser.add_argument("--update_baseline",
+                        action="store_true",
+                        help="store the measured throughputs as the new baseline instead of comparing.")
+    parser.add_argument("--benchmarks",
+                        nargs="+",
+                        choices=BENCHMARKS,
+                        default=list(BENCHMARKS))
+    parser.add_argument("--roi_size",
+                        type=int,
+                        default=4096,
+                        help="side length of the synthetic ROI on level 0.")
+    parser.add_argument("--slide_size",
+                        type=int,
+                        default=16384,
+                        help="width of the synthetic slide on level 0; its height is 3/4 of it.")
+    parser.add_argument("--batch_size",
+                        type=int,
+                        default=64)
+    parser.add_argument("--streaming",
+                        action="store_true",
+                        help="read patches tile by tile from the slide in segment_WSI.")
+    parser.add_argument("--num_threads",
+                        type=int,
+                        default=4,
+                        help="threads used by torch, fixed so that throughputs are comparable.")
+    parser.add_argument("--repeats",
+                        type=int,
+                        default=3,
+                        help="number of runs of every benchmark; the fastest one is reported.")
+    parser.add_argument("--wsi_repeats",
+                        type=int,
+                        default=1,
+                        help="number of runs of segment_WSI, which takes much longer than the other benchmarks.")
+    parser.add_argument("--tolerance",
+                        type=float,
+                        default=0.2,
+                        help="relative drop of throughput from the baseline tolerated before failing.")
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+
+    args.baseline_path = (Path.cwd() / Path(args.baseline_path)).resolve()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    sys.exit(0 if benchmark_inference(args) else 1)
@@ -0,0 +1,195 @@
+import sys
+sys.path.append("../")
+
+import argparse
+import json
+import subprocess
+import tempfile
+from pathlib import Path
+
+from ml_core.utils.synthetic_slides import generate_synthetic_ROI, write_synthetic_slide
+
+
+CASES = ("roi", "wsi")
+CLASS_NAMES = ("Glomerulus", "Artery", "Tubules")
+
+
+def create_random_label_info(class_names=CLASS_NAMES, depth=3, wf=2, seed=0):
+    """
+    Label info with randomly initialized models, so that the benchmark doesn't need trained checkpoints
+    """
+    import pandas as pd
+    import torch
+    from ml_core.modeling.unet import UNet
+
+    torch.manual_seed(seed)
+    rows = []
+    for label, class_name in enumerate(class_names, start=1):
+        rows.append({"label_name": class_name,
+                     "label": label,
+                     "color": "#4dd156",
+                     "min_size": 4000,
+                     "threshold": 0.5,
+                     "extractor_config_name": f"AAPI_{class_name}",
+                     "model": UNet(3, 2, depth, wf, True, True).eval()})
+    return pd.DataFrame(rows)
+
+
+def run_case(args):
+    """
+    Run one case in this process with a MemorySink, and print its summary as json
+    """
+    from ml_core.api import segment_ROI, segment_WSI
+    from ml_core.utils.profiling import MemorySink
+
+    label_info = create_random_label_info()
+
+    if args.run_case == "roi":
+        ROI, _ = generate_synthetic_ROI(args.roi_size, args.roi_size, seed=1)
+        with MemorySink() as sink:
+            segment_ROI([ROI], [(0, 0)], label_info=label_info, batch_size=args.batch_size, callback=sink)
+    else:
+        with MemorySink() as sink:
+            segment_WSI(args.slide_path, label_info=label_info, batch_size=args.batch_size,
+                        streaming=args.streaming, callback=sink)
+
+    print(json.dumps(sink.summary()))
+
+
+def measure_case(case, args):
+    # every case runs in a fresh interpreter, since the peak RSS of a process never goes down
+    command = [sys.executable, str(Path(__file__).resolve()), "--run_case", case,
+               "--roi_size", str(args.roi_size),
+               "--batch_size", str(args.batch_size)]
+    if case == "wsi":
+        command += ["--slide_path", str(args.slide_path)]
+        if args.streaming:
+            command.append("--streaming")
+
+    result = subprocess.run(command, cwd=Path(__file__).resolve().parent, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to run the {case} case:\n{result.stderr}")
+    summary = json.loads(result.stdout.strip().splitlines()[-1])
+
+    return {"traced_peak": summary["total"]["traced_peak"],
+            "peak_rss": summary["total"]["peak_rss"],
+            "stages": {stage: memory["traced_peak"] for stage, memory in summary.items() if stage != "total"}}
+
+
+def is_regression(value, baseline, tolerance, slack):
+    return value is not None and baseline is not None and value > baseline * (1 + tolerance) + slack
+
+
+def compare_with_baseline(case, measured, baseline, args):
+    """
+    Print measured peaks next to the baseline, and return False if any of them regressed
+    """
+    passed = True
+    rows = [("total traced", measured["traced_peak"], baseline.get("traced_peak"), args.traced_slack),
+            ("total peak RSS", measured["peak_rss"], baseline.get("peak_rss"), args.rss_slack)]
+    rows += [(f"{stage} traced", value, baseline.get("stages", {}).get(stage), args.traced_slack)
+             for stage, value in measured["stages"].items()]
+
+    for name, value, baseline_value, slack in rows:
+        regressed = is_regression(value, baseline_value, args.tolerance, slack)
+        passed = passed and not regressed
+        baseline_mb = "-" if baseline_value is None else f"{baseline_value / 1024 ** 2:.1f}"
+        value_mb = "-" if value is None else f"{value / 1024 ** 2:.1f}"
+        print(f"{case:<5}{name:<28}{value_mb:>10} MB (baseline: {baseline_mb:>8} MB) "
+              f"... {'REGRESSED' if regressed else 'ok'}")
+
+    return passed
+
+
+def benchmark_memory(args):
+    baselines = json.loads(args.baseline_path.read_text()) if args.baseline_path.exists() else {}
+    settings = {"roi_size": args.roi_size, "slide_size": args.slide_size,
+                "batch_size": args.batch_size, "streaming": args.streaming}
+    if baselines and baselines.get("settings") != settings:
+        print(f"[Warning] Baseline was measured with {baselines.get('settings')}, not {settings}.")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        args.slide_path = Path(tmp_dir) / "synthetic_slide.tif"
+        write_synthetic_slide(args.slide_path, args.slide_size, args.slide_size * 3 // 4)
+        measured = {case: measure_case(case, args) for case in args.cases}
+
+    if args.update_baseline:
+        baselines.update(measured)
+        baselines["settings"] = settings
+        args.baseline_path.write_text(json.dumps(baselines, indent=2))
+        print(f"Baseline written to {args.baseline_path}.")
+        return True
+
+    passed = True
+    for case in args.cases:
+        if case not in baselines:
+            print(f"[Warning] No baseline for the {case} case, run with --update_baseline first.")
+            continue
+        passed = compare_with_baseline(case, measured[case], baselines[case], args) and passed
+    return passed
+
+
+def parse_arguments(input_args=None):
+    parser = argparse.ArgumentParser(description="Check that the peak memory of every inference stage "
+                                                 "on synthetic inputs stays within a stored baseline.")
+
+    parser.add_argument("--baseline_path",
+                        default="memory_baseline.json",
+                        help="json file of the baseline peaks; regenerate it with --update_baseline "
+                             "when moving to another machine or after an intended change.")
+    parser.add_argument("--update_baseline",
+                        action="store_true",
+                        help="store the measured peaks as the new baseline instead of comparing.")
+    parser.add_argument("--cases",
+                        nargs="+",
+                        choices=CASES,
+                        default=list(CASES),
+                        help="roi runs segment_ROI on a synthetic ROI, wsi runs segment_WSI on a synthetic slide.")
+    parser.add_argument("--roi_size",
+                        type=int,
+                        default=2048,
+                        help="side length of the synthetic ROI on level 0.")
+    parser.add_argument("--slide_size",
+                        type=int,
+                        default=16384,
+                        help="width of the synthetic slide on level 0; its height is 3/4 of it.")
+    parser.add_argument("--batch_size",
+                        type=int,
+                        default=64)
+    parser.add_argument("--streaming",
+                        action="store_true",
+                        help="read patches tile by tile from the slide in the wsi case.")
+    parser.add_argument("--tolerance",
+                        type=float,
+                        default=0.1,
+                        help="relative increase over the baseline tolerated before failing.")
+    parser.add_argument("--traced_slack",
+                        type=int,
+                        default=1024 ** 2,
+                        help="bytes tolerated on top of the relative tolerance for traced peaks.")
+    parser.add_argument("--rss_slack",
+                        type=int,
+                        default=32 * 1024 ** 2,
+                        help="bytes tolerated on top of the relative tolerance for the peak RSS.")
+    parser.add_argument("--run_case",
+                        choices=CASES,
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--slide_path",
+                        help=argparse.SUPPRESS)
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+
+    args.baseline_path = (Path.cwd() / Path(args.baseline_path)).resolve()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.run_case is not None:
+        run_case(args)
+    else:
+        sys.exit(0 if benchmark_memory(args) else 1)
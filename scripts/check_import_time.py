@@ -0,0 +1,82 @@
+import sys
+sys.path.append("../")
+
+import argparse
+import json
+import subprocess
+from pathlib import Path
+
+
+# packages that must only be imported at first use
+HEAVY_PACKAGES = ("torch", "torchvision", "pytorch_lightning", "detectron2", "cv2", "pandas",
+                  "shapely", "lxml", "scipy", "skimage", "openslide", "tables")
+
+DEFAULT_BUDGETS_MS = {
+    "ml_core.api": 100,
+    "format_converter": 300,
+}
+
+
+def measure_import_time(module_name, repo_root):
+    """
+    Cumulative import time of a module in milliseconds, measured by "python -X importtime"
+    in a fresh interpreter, and the heavy packages it imports
+    """
+    code = f"import sys, json, {module_name}; " \
+           f"print(json.dumps([p for p in {HEAVY_PACKAGES!r} if p in sys.modules]))"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                            cwd=repo_root, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to import {module_name}:\n{result.stderr}")
+
+    # lines look like "import time:  self [us] | cumulative | imported package"
+    cumulative_us = None
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, package = line[len("import time:"):].split("|")
+        if package.strip() == module_name:
+            cumulative_us = int(cumulative)
+
+    return cumulative_us / 1000, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def check_import_time(args):
+    passed = True
+    for module_name, budget_ms in args.budgets.items():
+        import_time_ms = min(measure_import_time(module_name, args.repo_root)[0] for _ in range(args.repeats))
+        _, heavy_packages = measure_import_time(module_name, args.repo_root)
+
+        status = "ok" if import_time_ms <= budget_ms and not heavy_packages else "FAILED"
+        passed = passed and status == "ok"
+        print(f"{module_name}: {import_time_ms:.1f} ms (budget: {budget_ms} ms); "
+              f"heavy packages imported: {heavy_packages or 'none'} ... {status}")
+
+    return passed
+
+
+def parse_arguments(input_args=None):
+    parser = argparse.ArgumentParser(description="Check that importing the packages stays within a time budget.")
+
+    parser.add_argument("--budgets",
+                        type=json.loads,
+                        default=DEFAULT_BUDGETS_MS,
+                        help="json object mapping module names to their import time budgets in milliseconds.")
+    parser.add_argument("--repeats",
+                        type=int,
+                        default=3,
+                        help="number of measurements per module; the fastest one is compared to the budget.")
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+
+    args.repo_root = Path(__file__).resolve().parent.parent
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    sys.exit(0 if check_import_time(args) else 1)
@@ -0,0 +1,75 @@
+import sys
+sys.path.append("../")
+
+import argparse
+import tempfile
+from pathlib import Path
+
+from benchmark_memory import create_random_label_info
+from ml_core.utils.synthetic_slides import write_synthetic_slide
+
+
+def check_streaming_consistency(args):
+    """
+    Check that biopsies, and so the bounding boxes of masks, are the same with and without streaming
+    on a synthetic slide; returns False if they differ
+    """
+    from ml_core.api import segment_WSI
+    from ml_core.modeling.postprocessing import read_slide_and_detect_biopsies, get_biopsy_bbox
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        slide_path = Path(tmp_dir) / "synthetic_slide.tif"
+        write_synthetic_slide(slide_path, args.slide_size, args.slide_size * 3 // 4, seed=args.seed)
+
+        bboxes = {}
+        for streaming in (False, True):
+            _, _, biopsy_contours = read_slide_and_detect_biopsies(slide_path, streaming=streaming)
+            bboxes[streaming] = [get_biopsy_bbox(c) for c in biopsy_contours]
+            print(f"streaming={streaming}: bounding boxes {bboxes[streaming]}")
+        passed = bboxes[False] == bboxes[True] and len(bboxes[False]) > 0
+
+        if args.with_inference:
+            # a single small random model, since only the sizes of masks are compared
+            label_info = create_random_label_info(class_names=("Glomerulus",))
+            mask_shapes = {}
+            for streaming in (False, True):
+                _, masks = segment_WSI(slide_path, label_info=label_info.copy(), batch_size=args.batch_size,
+                                       return_masks=True, streaming=streaming)
+                mask_shapes[streaming] = [[mask.shape for mask in biopsy_masks] for biopsy_masks in masks]
+                print(f"streaming={streaming}: mask shapes {mask_shapes[streaming]}")
+            passed = passed and mask_shapes[False] == mask_shapes[True]
+
+    print("ok" if passed else "FAILED: streaming and non-streaming biopsies differ")
+    return passed
+
+
+def parse_arguments(input_args=None):
+    parser = argparse.ArgumentParser(description="Check that streaming and non-streaming WSI inference "
+                                                 "detect the same biopsies on a synthetic slide.")
+
+    parser.add_argument("--slide_size",
+                        type=int,
+                        default=16384,
+                        help="width of the synthetic slide on level 0; its height is 3/4 of it.")
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0,
+                        help="seed of the synthetic slide.")
+    parser.add_argument("--with_inference",
+                        action="store_true",
+                        help="also run segment_WSI in both modes and compare the sizes of masks.")
+    parser.add_argument("--batch_size",
+                        type=int,
+                        default=64)
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    sys.exit(0 if check_streaming_consistency(args) else 1)
@@ -0,0 +1,75 @@
+import sys
+sys.path.append("../")
+
+import argparse
+import configparser
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from ml_core.api import default_label_info_path
+from ml_core.modeling.postprocessing import get_latest_model_from_dir, load_model_from_checkpoint
+from ml_core.modeling.onnx_model import export_model_to_onnx, ONNXModel
+from ml_core.preprocessing.patches_extraction import Extractor
+
+
+def export_models(args):
+    config = configparser.ConfigParser()
+    config.read(args.label_info_path)
+
+    for section_name in config.sections():
+        model_root = args.label_info_path.parent / Path(config[section_name]["model_root"])
+        ckpt_path = get_latest_model_from_dir(model_root / section_name, suffix=".ckpt")
+        if ckpt_path is None:
+            print(f"[Warning] No saved checkpoints found at {model_root / section_name}.")
+            continue
+
+        # same name as the checkpoint, so that the latest checkpoint maps to the latest graph
+        onnx_path = ckpt_path.with_suffix(".onnx")
+        if onnx_path.exists() and not args.overwrite:
+            print(f"{section_name}: {onnx_path} already exists.")
+            continue
+
+        model = load_model_from_checkpoint(ckpt_path)
+        patch_size = Extractor(config_section_name=f"AAPI_{section_name}").patch_size
+        in_channels = model.hparams.get("in_channels", 3)
+        export_model_to_onnx(model, onnx_path, patch_size, in_channels=in_channels, opset_version=args.opset_version)
+
+        # compare outputs of the exported graph with the checkpoint
+        dummy_input = torch.rand((2, in_channels, patch_size, patch_size))
+        with torch.no_grad():
+            expected = model.cpu().eval()(dummy_input).numpy()
+        actual = ONNXModel(onnx_path)(dummy_input).numpy()
+        error = np.abs(actual - expected).max()
+
+        print(f"{section_name}: exported {ckpt_path.name} to {onnx_path}; max abs error of logits: {error:.2e}")
+
+
+def parse_arguments(input_args=None):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--label_info_path",
+                        default=str(default_label_info_path),
+                        help="the config .ini file containing class labels and model locations.")
+    parser.add_argument("--opset_version",
+                        type=int,
+                        default=11,
+                        help="ONNX opset used for the export.")
+    parser.add_argument("--overwrite",
+                        action="store_true",
+                        help="export again even if the graph of the latest checkpoint already exists.")
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+
+    args.label_info_path = (Path.cwd() / Path(args.label_info_path)).resolve()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    export_models(args)
@@ -0,0 +1,68 @@
+import sys
+sys.path.append("../")
+
+import argparse
+import configparser
+from pathlib import Path
+
+import torch
+
+from ml_core.api import default_label_info_path
+from ml_core.modeling.postprocessing import get_latest_model_from_dir, load_model_from_checkpoint
+from ml_core.modeling.slim_checkpoint import export_slim_checkpoint, load_slim_checkpoint
+from ml_core.preprocessing.patches_extraction import Extractor
+
+
+def export_models(args):
+    config = configparser.ConfigParser()
+    config.read(args.label_info_path)
+
+    for section_name in config.sections():
+        model_root = args.label_info_path.parent / Path(config[section_name]["model_root"])
+        ckpt_path = get_latest_model_from_dir(model_root / section_name, suffix=".ckpt")
+        if ckpt_path is None:
+            print(f"[Warning] No saved checkpoints found at {model_root / section_name}.")
+            continue
+
+        # same name as the checkpoint, so that the latest checkpoint maps to the latest slim checkpoint
+        slim_path = ckpt_path.with_suffix(".slim")
+        if slim_path.exists() and not args.overwrite:
+            print(f"{section_name}: {slim_path} already exists.")
+            continue
+
+        model = load_model_from_checkpoint(ckpt_path).cpu().eval()
+        export_slim_checkpoint(model, slim_path)
+
+        # the slim checkpoint must reproduce the outputs of the lightning checkpoint exactly
+        patch_size = Extractor(config_section_name=f"AAPI_{section_name}").patch_size
+        dummy_input = torch.rand((2, model.hparams.get("in_channels", 3), patch_size, patch_size))
+        with torch.no_grad():
+            identical = torch.equal(model(dummy_input), load_slim_checkpoint(slim_path)(dummy_input))
+
+        print(f"{section_name}: exported {ckpt_path.name} ({ckpt_path.stat().st_size / 1024 ** 2:.1f} MB) "
+              f"to {slim_path} ({slim_path.stat().st_size / 1024 ** 2:.1f} MB); identical outputs: {identical}")
+
+
+def parse_arguments(input_args=None):
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--label_info_path",
+                        default=str(default_label_info_path),
+                        help="the config .ini file containing class labels and model locations.")
+    parser.add_argument("--overwrite",
+                        action="store_true",
+                        help="export again even if the slim checkpoint of the latest checkpoint already exists.")
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+
+    args.label_info_path = (Path.cwd() / Path(args.label_info_path)).resolve()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    export_models(args)
@@ -0,0 +1,89 @@
+import sys
+sys.path.append("../")
+
+import argparse
+import time
+from pathlib import Path
+
+from ml_core.utils.synthetic_slides import write_synthetic_slide
+
+
+def generate_slides(args):
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    for slide_id in range(args.n_slides):
+        seed = args.seed + slide_id
+        slide_path = args.output_dir / f"synthetic_{args.width}x{args.height}_{seed}.tif"
+        annotation_path = slide_path.with_suffix(".xml") if args.with_annotations else None
+
+        start = time.time()
+        tissue = write_synthetic_slide(slide_path,
+                                       args.width,
+                                       args.height,
+                                       n_levels=args.n_levels,
+                                       tile_size=args.tile_size,
+                                       compression=None if args.compression == "none" else args.compression,
+                                       annotation_path=annotation_path,
+                                       seed=seed,
+                                       n_biopsies=args.n_biopsies,
+                                       objects_per_biopsy=args.objects_per_biopsy)
+        print(f"{slide_path}: {len(tissue.biopsies)} biopsies, {len(tissue.objects)} objects, "
+              f"{slide_path.stat().st_size / 1024 ** 2:.1f} MB, written in {time.time() - start:.1f} s")
+
+
+def parse_arguments(input_args=None):
+    parser = argparse.ArgumentParser(description="Generate pyramidal tiled TIFF slides of synthetic tissue, "
+                                                 "readable by openslide, for benchmarks and tests.")
+
+    parser.add_argument("--output_dir",
+                        default="../data/synthetic_slides",
+                        help="directory of the generated slides.")
+    parser.add_argument("--width",
+                        type=int,
+                        default=20000,
+                        help="width of level 0 in pixels.")
+    parser.add_argument("--height",
+                        type=int,
+                        default=15000,
+                        help="height of level 0 in pixels.")
+    parser.add_argument("--n_slides",
+                        type=int,
+                        default=1)
+    parser.add_argument("--n_levels",
+                        type=int,
+                        default=3,
+                        help="number of levels, every one downsampled by 4 from the previous one.")
+    parser.add_argument("--tile_size",
+                        type=int,
+                        default=256)
+    parser.add_argument("--compression",
+                        default="zlib",
+                        help="TIFF compression of tiles, e.g., zlib, none, or jpeg if imagecodecs is installed.")
+    parser.add_argument("--n_biopsies",
+                        type=int,
+                        default=4)
+    parser.add_argument("--objects_per_biopsy",
+                        type=int,
+                        default=8,
+                        help="number of objects of every class in every biopsy.")
+    parser.add_argument("--with_annotations",
+                        action="store_true",
+                        help="also write the objects of every slide to an ASAP annotation file next to it.")
+    parser.add_argument("--seed",
+                        type=int,
+                        default=0,
+                        help="seed of the first slide; the following slides use the next seeds.")
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+
+    args.output_dir = (Path.cwd() / Path(args.output_dir)).resolve()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    generate_slides(args)
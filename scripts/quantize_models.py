@@ -0,0 +1,139 @@
+import sys
+sys.path.append("../")
+
+import argparse
+import configparser
+import time
+from pathlib import Path
+
+import pandas as pd
+import torch
+
+from ml_core.api import default_label_info_path
+from ml_core.preprocessing.dataset import Dataset
+from ml_core.modeling.postprocessing import get_latest_model_from_dir, load_model_from_checkpoint
+from ml_core.modeling.quantization import quantize_model, compute_f1_score, save_quantized_model, \
+    sample_dataloader, load_quantized_model
+
+
+def measure_latency(model, example_input, repeats=5):
+    with torch.no_grad():
+        model(example_input)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            model(example_input)
+    return (time.perf_counter() - start) / repeats
+
+
+def quantize_models(args):
+    config = configparser.ConfigParser()
+    config.read(args.label_info_path)
+    hdf5_dir = args.data_root / Path(f"{args.dataset_name}/hdf5_data/patch_{args.patch_size}")
+
+    reports = []
+    for section_name in config.sections():
+        if args.class_names and section_name not in args.class_names:
+            continue
+
+        model_root = args.label_info_path.parent / Path(config[section_name]["model_root"])
+        ckpt_path = get_latest_model_from_dir(model_root / section_name, suffix=".ckpt")
+        if ckpt_path is None:
+            print(f"[Warning] No saved checkpoints found at {model_root / section_name}.")
+            continue
+
+        # same name as the checkpoint, so that the latest checkpoint maps to the latest quantized model
+        quantized_path = ckpt_path.with_suffix(".int8.pt")
+        if quantized_path.exists() and not args.overwrite:
+            print(f"{section_name}: {quantized_path} already exists.")
+            continue
+
+        model = load_model_from_checkpoint(ckpt_path).cpu().eval()
+        calibration_data = sample_dataloader(Dataset(hdf5_dir / f"{section_name}_train.h5", use_edge_mask=False),
+                                             args.calibration_size,
+                                             args.batch_size)
+        val_data = sample_dataloader(Dataset(hdf5_dir / f"{section_name}_val.h5", use_edge_mask=False),
+                                     args.val_size,
+                                     args.batch_size)
+
+        quantized_model = quantize_model(model, calibration_data, engine=args.engine)
+        example_input, *_ = next(iter(val_data))
+        save_quantized_model(quantized_model, quantized_path, example_input)
+
+        # evaluate the saved model, i.e., exactly what the inference path will load
+        quantized_model = load_quantized_model(quantized_path)
+        fp32_f1 = compute_f1_score(model, val_data)
+        int8_f1 = compute_f1_score(quantized_model, val_data)
+
+        reports.append({
+            "class": section_name,
+            "fp32_f1": fp32_f1,
+            "int8_f1": int8_f1,
+            "f1_delta": int8_f1 - fp32_f1,
+            "fp32_latency": measure_latency(model, example_input),
+            "int8_latency": measure_latency(quantized_model, example_input),
+            "path": str(quantized_path),
+        })
+        print(f"{section_name}: saved to {quantized_path}; F1 {fp32_f1:.4f} -> {int8_f1:.4f}")
+
+    report = pd.DataFrame(reports)
+    print("=" * 25)
+    print(report.to_string(index=False) if len(report) else "No models quantized.")
+    print("=" * 25)
+    return report
+
+
+def parse_arguments(input_args=None):
+    parser = argparse.ArgumentParser()
+
+    # positional arguments
+    parser.add_argument("data_root",
+                        help="root directory containing data; relative to the script")
+
+    # optional arguments
+    parser.add_argument("--label_info_path",
+                        default=str(default_label_info_path),
+                        help="the config .ini file containing class labels and model locations.")
+    parser.add_argument("--class_names",
+                        nargs="*",
+                        default=None,
+                        help="classes to quantize; separated by space; all classes in label_info if not specified.")
+    parser.add_argument("--dataset_name",
+                        default="AAPI",
+                        help="dataset whose hdf5 patches are used for calibration and validation.")
+    parser.add_argument("--patch_size",
+                        type=int,
+                        default=256,
+                        help="size of cropped patches in the hdf5 files")
+    parser.add_argument("--calibration_size",
+                        type=int,
+                        default=512,
+                        help="number of training patches used for calibration.")
+    parser.add_argument("--val_size",
+                        type=int,
+                        default=None,
+                        help="number of validation patches used for the F1 score; all patches if not specified.")
+    parser.add_argument("--batch_size",
+                        type=int,
+                        default=16,
+                        help="batch size for calibration and validation.")
+    parser.add_argument("--engine",
+                        default=None,
+                        help="quantized engine, e.g., x86 or fbgemm; the default engine of the platform if not specified.")
+    parser.add_argument("--overwrite",
+                        action="store_true",
+                        help="quantize again even if the latest checkpoint has been quantized.")
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+
+    args.data_root = (Path.cwd() / Path(args.data_root)).resolve()
+    args.label_info_path = (Path.cwd() / Path(args.label_info_path)).resolve()
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    quantize_models(args)
@@ -0,0 +1,178 @@
+import sys
+sys.path.append("../")
+
+import argparse
+import os
+import time
+import traceback
+import multiprocessing
+from pathlib import Path
+
+import pandas as pd
+import torch
+
+from ml_core.api import segment_WSI, default_label_info_path
+from ml_core.modeling.postprocessing import load_label_info_from_config
+from ml_core.utils.slide_utils import get_slide_paths, read_slide
+
+
+# loaded once in every worker process by "init_worker"
+_worker_label_info = None
+
+
+def init_worker(label_info_path, torch_threads):
+    global _worker_label_info
+    torch.set_num_threads(torch_threads)
+    _worker_label_info = load_label_info_from_config(label_info_path)
+
+
+def segment_slide(slide_path, output_path, batch_size, streaming, tile_size):
+    report = {
+        "slide": str(slide_path),
+        "output": str(output_path),
+        "status": "done",
+        "wall_time": 0.,
+        "megapixels": 0.,
+    }
+
+    start = time.perf_counter()
+    try:
+        slide = read_slide(slide_path)
+        width, height = slide.level_dimensions[0]
+        report["megapixels"] = width * height / 1e6
+        slide.close()
+
+        xml_annotation = segment_WSI(slide_path,
+                                     label_info=_worker_label_info,
+                                     batch_size=batch_size,
+                                     streaming=streaming,
+                                     tile_size=tile_size)
+
+        # write to a temporary file first, so that a killed worker
+        # never leaves a partial output which would be skipped next time
+        tmp_path = output_path.with_suffix(".xml.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(xml_annotation)
+        os.replace(tmp_path, output_path)
+
+    except Exception:
+        report["status"] = "failed"
+        print(f"[Warning] Failed to segment {slide_path}:\n{traceback.format_exc()}")
+
+    report["wall_time"] = time.perf_counter() - start
+    return report
+
+
+def segment_slides(args):
+    slide_paths = get_slide_paths(args.slide_dir, suffixes=args.suffixes)
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+
+    tasks = []
+    skipped = 0
+    for slide_path in slide_paths:
+        # mirror the subfolders of slides, so that slides with the same name don't overwrite each other's output
+        output_path = args.output_dir / slide_path.relative_to(args.slide_dir).with_suffix(".xml")
+        if output_path.exists() and not args.overwrite:
+            skipped += 1
+            continue
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        tasks.append((slide_path, output_path, args.batch_size, args.streaming, args.tile_size))
+
+    print(f"Found {len(slide_paths)} slides; {skipped} already segmented, {len(tasks)} to go "
+          f"with {args.workers} workers.")
+    if not tasks:
+        return None
+
+    # spawn fresh interpreters, since forking after torch has started threads is unsafe
+    context = multiprocessing.get_context("spawn")
+    torch_threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    reports = []
+    start = time.perf_counter()
+    with context.Pool(processes=args.workers,
+                      initializer=init_worker,
+                      initargs=(args.label_info_path, torch_threads)) as pool:
+        imap = pool.imap if args.ordered else pool.imap_unordered
+        for report in imap(_segment_slide_star, tasks):
+            reports.append(report)
+            print(f"[{len(reports)}/{len(tasks)}] {report['status']}: {Path(report['slide']).name} "
+                  f"in {report['wall_time']:.1f}s "
+                  f"({report['megapixels'] / max(report['wall_time'], 1e-9):.2f} MP/s)")
+    total_time = time.perf_counter() - start
+
+    report = pd.DataFrame(reports)
+    report["megapixels_per_second"] = report["megapixels"] / report["wall_time"]
+    report.to_csv(args.output_dir / "segmentation_report.csv", index=False)
+
+    done = report[report["status"] == "done"]
+    print("=" * 25)
+    print(f"Segmented {len(done)}/{len(report)} slides in {total_time:.1f}s; "
+          f"throughput: {len(done) / total_time * 3600:.1f} slides/hour, "
+          f"{done['megapixels'].sum() / total_time:.2f} MP/s.")
+    print("=" * 25)
+
+    return report
+
+
+def _segment_slide_star(task):
+    return segment_slide(*task)
+
+
+def parse_arguments(input_args=None):
+    parser = argparse.ArgumentParser()
+
+    # positional arguments
+    parser.add_argument("slide_dir",
+                        help="directory containing slides, searched recursively; relative to the script")
+    parser.add_argument("output_dir",
+                        help="directory for ASAP xml annotations, one per slide, in the same subfolders "
+                             "as slides in slide_dir; relative to the script")
+
+    # optional arguments
+    parser.add_argument("--label_info_path",
+                        default=str(default_label_info_path),
+                        help="the config .ini file containing class labels and model locations.")
+    parser.add_argument("--suffixes",
+                        nargs="*",
+                        default=[".tif", ".svs"],
+                        help="file suffixes of slides; separated by space.")
+    parser.add_argument("-j", "--workers",
+                        type=int,
+                        default=min(4, os.cpu_count() or 1),
+                        help="number of worker processes; every worker loads its own models and reads its own "
+                             "slide, so memory grows with workers, especially with --no_streaming.")
+    parser.add_argument("--batch_size",
+                        type=int,
+                        default=64,
+                        help="batch size for inference.")
+    parser.add_argument("--no_streaming",
+                        dest="streaming",
+                        action="store_false",
+                        help="load the full level 1 image of every slide instead of reading it tile by tile.")
+    parser.add_argument("--tile_size",
+                        type=int,
+                        default=2048,
+                        help="side length of tiles read in streaming mode.")
+    parser.add_argument("--overwrite",
+                        action="store_true",
+                        help="segment slides again even if the output already exists.")
+    parser.add_argument("--ordered",
+                        action="store_true",
+                        help="report slides in input order instead of completion order.")
+
+    if input_args is not None:
+        args = parser.parse_args(input_args)
+    else:
+        args = parser.parse_args()
+
+    args.slide_dir = (Path.cwd() / Path(args.slide_dir)).resolve()
+    args.output_dir = (Path.cwd() / Path(args.output_dir)).resolve()
+    args.label_info_path = (Path.cwd() / Path(args.label_info_path)).resolve()
+    args.workers = max(1, args.workers)
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    segment_slides(args)